@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'drf_spectacular',
     'rest_framework',
     'rest_framework_simplejwt.token_blacklist',
@@ -132,6 +133,41 @@ broker_port = os.getenv('BROKER_PORT')
 
 CELERY_BROKER_URL = f'amqp://{broker_user}:{broker_password}@{broker_host}:{broker_port}//'
 CELERY_RESULT_BACKEND = f'rpc://'
+CELERY_BEAT_SCHEDULE = {
+    'finish-expired-sessions': {
+        'task': 'Learning_platform.tasks.finish_expired_sessions',
+        'schedule': 15.0,
+    },
+    'flush-answer-buffers': {
+        'task': 'Learning_platform.tasks.flush_answer_buffers',
+        'schedule': 30.0,
+    },
+}
+
+# Shared cache for course outlines, role lookups etc.
+# Falls back to per-process memory when no redis is configured.
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Only a shared (redis) cache is seen by both the web processes and the celery worker, caches that
+# have to stay coherent across them (course roles, conditional GET validators) are used only then.
+SHARED_CACHE = bool(REDIS_URL)
+
+# Keep in-progress test answers in the cache and write them to the db in bulk
+# (on submit / finish and every 30s). Needs the shared redis cache.
+TEST_ANSWERS_WRITE_BEHIND = bool(REDIS_URL) and os.getenv('TEST_ANSWERS_WRITE_BEHIND') == '1'
 
 
 AUTH_USER_MODEL = 'main.SiteUser'
@@ -153,6 +189,9 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# files written by background gradebook exports
+GRADEBOOK_EXPORT_DIR = BASE_DIR / 'exports'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,11 +1,17 @@
 
 
+from collections import defaultdict
+
 from celery import shared_task
+from django.apps import apps
 from django.db import transaction
-from django.utils import timezone
 
-from courses_app.models import CourseJoinRequests
-from courses_app.utils import check_test_results
+from courses_app.models import CourseJoinRequests, CourseRoles, Course, TestQuestions
+from courses_app.gradebook import write_gradebook
+from courses_app.grading import finish_session, sweep_expired_sessions
+from courses_app.ordering import rebalance
+from courses_app.utils import invalidate_course_roles
+from student_app.answer_buffer import flush_session_buffer, write_behind_enabled
 from student_app.models import TestSession
 
 
@@ -31,17 +37,86 @@ def change_request_status_and_add(request_id,new_status):
 
     return f"Invalid status {new_status}"
 
+@shared_task
+def moderate_join_requests(course_id, decisions):
+    """
+    Applies a batch of [request_id, new_status] pairs of one course.
+    Requests locked by another worker or already moderated are skipped.
+    """
+    decisions = {int(request_id): new_status for request_id, new_status in decisions}
+    with transaction.atomic():
+        pending = list(CourseJoinRequests.objects.select_for_update(skip_locked=True, of=('self',))
+                       .filter(course_id=course_id, id__in=decisions, status='on_mod')
+                       .values_list('id', 'user_id', 'user__role'))
+        approved = [(request_id, user_id, role) for request_id, user_id, role in pending
+                    if decisions[request_id] == 'approved']
+        rejected = [request_id for request_id, _, _ in pending if decisions[request_id] == 'rejected']
+
+        CourseJoinRequests.objects.filter(id__in=[request_id for request_id, _, _ in approved]) \
+            .update(status='approved')
+        CourseJoinRequests.objects.filter(id__in=rejected).update(status='rejected')
+
+        Membership = Course.users.through
+        Membership.objects.bulk_create([Membership(course_id=course_id, siteuser_id=user_id)
+                                        for _, user_id, _ in approved], ignore_conflicts=True)
+        CourseRoles.objects.bulk_create([CourseRoles(course_id=course_id, user_id=user_id,
+                                                     course_role='staff' if role == 'staff' else 'student')
+                                         for _, user_id, role in approved], ignore_conflicts=True)
+        approved_users = [user_id for _, user_id, _ in approved]
+        transaction.on_commit(lambda: invalidate_course_roles(course_id, approved_users))
+
+    return f"Approved {len(approved)}, rejected {len(rejected)}, skipped {len(decisions) - len(pending)}"
+
 @shared_task
 def finish_test(session_uuid):
+    # kept for ETA tasks queued before the deadline sweeper, finishing twice is a no-op
+    if finish_session(session_uuid) is None:
+        return f"Session {session_uuid} does not exist or is already finished"
+    return f"Session {session_uuid} finished"
+
+
+@shared_task
+def finish_expired_sessions():
+    return f"Finished {sweep_expired_sessions()} expired sessions"
+
+
+@shared_task
+def flush_answer_buffers():
+    """Periodic write-behind flush, bounds what a cache loss can take to one interval"""
+    if not write_behind_enabled():
+        return "Write-behind is off"
+    sessions = TestSession.objects.filter(is_finished=False).only('uuid', 'test_block_id', 'is_finished')
+    questions = defaultdict(list)
+    for test_block_id, question_id in TestQuestions.objects.filter(
+            test_block_id__in=sessions.values('test_block_id')).values_list('test_block_id', 'id'):
+        questions[test_block_id].append(question_id)
+
+    count = 0
+    for session_pk in sessions.values_list('pk', flat=True).iterator(chunk_size=500):
+        # under the row lock close_session takes, a session finished since the list was read is skipped
+        # instead of getting its graded answers overwritten; one being closed right now is left to it
+        with transaction.atomic():
+            session = TestSession.objects.select_for_update(skip_locked=True) \
+                .filter(pk=session_pk, is_finished=False).only('uuid', 'test_block_id', 'is_finished').first()
+            if session is None:
+                continue
+            flush_session_buffer(session, questions[session.test_block_id])
+        count += 1
+    return f"Checked {count} sessions"
+
+
+@shared_task
+def export_gradebook(course_id, export_format, file_name):
     try:
-        session = TestSession.objects.get(uuid=session_uuid)
-    except TestSession.DoesNotExist:
-        return f"Session {session_uuid} does not exist"
-    questions = session.test_block.questions.all()
+        course = Course.objects.get(pk=course_id)
+    except Course.DoesNotExist:
+        return f"Course {course_id} does not exist"
+    write_gradebook(course, export_format, file_name)
+    return f"Gradebook of course {course_id} written to {file_name}"
 
-    with transaction.atomic():
-        check_test_results(questions, session)
-        session.is_finished = True
-        session.finished_at = timezone.now()
-        session.save()
 
+@shared_task
+def rebalance_order_keys(model_label, parent_id):
+    """Respaces sibling ranks once inserts used up the gap somewhere, see courses_app.ordering"""
+    rebalance(apps.get_model(model_label), parent_id)
+    return f"Rebalanced {model_label} under {parent_id}"
@@ -1,3 +1,6 @@
+from collections import defaultdict
+
+from django.db import models
 from rest_framework import serializers
 
 from courses_app.models import Course, CourseRoles
@@ -12,21 +15,59 @@ class AdmRoleinCourseSerializer(serializers.ModelSerializer):
         model = Course
         fields = ['id','title','user_role']
 
+def load_users_courses(user_ids):
+    """
+    Joined courses, created courses and course roles of the given users in three queries,
+    grouped by user id
+    """
+    roles = defaultdict(dict)
+    for user_id, course_id, course_role in CourseRoles.objects.filter(user_id__in=user_ids) \
+            .values_list('user_id', 'course_id', 'course_role'):
+        roles[user_id][course_id] = course_role
+
+    joined = defaultdict(list)
+    memberships = Course.users.through.objects.filter(siteuser_id__in=user_ids).select_related('course') \
+        .only('siteuser_id', 'course__owner_id', 'course__title').order_by('course_id')
+    for membership in memberships:
+        if membership.course.owner_id != membership.siteuser_id:
+            joined[membership.siteuser_id].append(membership.course)
+
+    created = defaultdict(list)
+    for course in Course.objects.filter(owner_id__in=user_ids).only('owner_id', 'title').order_by('id'):
+        created[course.owner_id].append(course)
+    return {'roles': roles, 'joined': joined, 'created': created}
+
+
+class AdminUsersListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.child.context['users_courses'] = load_users_courses([user.pk for user in users])
+        return super().to_representation(users)
+
+
 class AdminAllUsersSerializer(serializers.ModelSerializer):
     courses = serializers.SerializerMethodField()
     created_courses = serializers.SerializerMethodField()
     class Meta:
         model = SiteUser
         fields = ['id','username','role','status','is_superuser','courses','created_courses']
+        list_serializer_class = AdminUsersListSerializer
+
+    def get_users_courses(self, obj):
+        users_courses = self.context.get('users_courses')
+        if users_courses is None:
+            users_courses = self.context['users_courses'] = load_users_courses([obj.pk])
+        return users_courses
 
     def get_courses(self, obj):
-        courses = obj.course_users.exclude(owner=obj)
-        serializer = CourseMiniForAdminSerializer(courses, many=True,context={'target_user':obj})
+        users_courses = self.get_users_courses(obj)
+        serializer = CourseMiniForAdminSerializer(users_courses['joined'][obj.pk], many=True,
+                                                  context={'user_roles': users_courses['roles'][obj.pk]})
         return serializer.data
 
     def get_created_courses(self, obj):
-        course = Course.objects.filter(owner=obj)
-        return CourseMiniForAdminSerializer(course, many=True).data
+        courses = self.get_users_courses(obj)['created'][obj.pk]
+        return CourseMiniForAdminSerializer(courses, many=True).data
 
 class AdminTeacherApproveSerializer(serializers.ModelSerializer):
     role = serializers.CharField(source='user_role',required=False)
@@ -1,3 +1,56 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+import pytest
+
+from administration.serializers import AdminAllUsersSerializer
+from courses_app.models import Course, CourseRoles
+from main.models import SiteUser
+
+from conftest import *
+
+
+@pytest.mark.django_db
+def test_adm_user_list_stream(staff_with_auth, user_student):
+    SiteUser.objects.bulk_create([SiteUser(username=f'bulk{i}', role='student') for i in range(5)])
+    response = staff_with_auth.get('/adm/users/?stream=true')
+    assert response.status_code == 200
+    assert response.streaming
+    data = json.loads(b''.join(response.streaming_content))
+    ids = [user['id'] for user in data]
+    assert ids == sorted(SiteUser.objects.values_list('id', flat=True))
+
+
+@pytest.mark.django_db
+def test_adm_user_list_keyset_pages(staff_with_auth, user_student):
+    SiteUser.objects.bulk_create([SiteUser(username=f'bulk{i}', role='student') for i in range(5)])
+    seen, cursor = [], ''
+    while True:
+        response = staff_with_auth.get(f'/adm/users/?paginate=true&page_size=2&cursor={cursor}')
+        assert response.status_code == 200
+        assert len(response.data['results']) <= 2
+        seen += [user['id'] for user in response.data['results']]
+        cursor = response.data['next']
+        if not cursor:
+            break
+    assert seen == sorted(SiteUser.objects.values_list('id', flat=True))
+
+
+@pytest.mark.django_db
+def test_adm_users_serializer_query_count(user_teacher_approved, django_assert_num_queries):
+    students = SiteUser.objects.bulk_create([SiteUser(username=f'bulk{i}', role='student') for i in range(10)])
+    for i in range(3):
+        course = Course.objects.create(owner=user_teacher_approved, title=f'course {i}', short_description='test')
+        course.users.add(user_teacher_approved, *students)
+        CourseRoles.objects.bulk_create([CourseRoles(course=course, user=student, course_role='student')
+                                         for student in students])
+
+    with django_assert_num_queries(4):
+        data = AdminAllUsersSerializer(SiteUser.objects.all(), many=True).data
+    by_id = {user['id']: user for user in data}
+    assert len(by_id[user_teacher_approved.id]['created_courses']) == 3
+    assert by_id[user_teacher_approved.id]['courses'] == []
+    assert [course['user_role'] for course in by_id[students[0].id]['courses']] == ['student'] * 3
+
+    with django_assert_num_queries(3):
+        data = AdminAllUsersSerializer(students[0]).data
+    assert len(data['courses']) == 3
@@ -1,6 +1,7 @@
 from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from drf_spectacular.utils import extend_schema, OpenApiResponse
+from drf_spectacular.utils import extend_schema, OpenApiResponse, OpenApiParameter
 from rest_framework import viewsets, status
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.decorators import action
@@ -12,6 +13,10 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from administration.serializers import AdminAllUsersSerializer, AdminTeacherApproveSerializer, AdminCourseSerializer, \
     AdmCourseUserRedactSerializer
 from courses_app.models import Course, CourseRoles, CourseJoinRequests
+from courses_app.pagination import KeysetPagination
+from courses_app.serializers import CourseBulkEnrollSerializer
+from courses_app.streaming import json_array_stream
+from courses_app.utils import invalidate_course_roles, query_flag
 from main.models import SiteUser
 from main.permissions import Staff
 from student_app.models import TestSession
@@ -28,7 +33,17 @@ class AdministrationUserList(APIView):
         responses={
             200: OpenApiResponse(description='User list'),
             403: OpenApiResponse(description='NonAdmin request'),
-        }
+        },
+        parameters=[
+            OpenApiParameter(name='role', location=OpenApiParameter.QUERY, required=False, type=str),
+            OpenApiParameter(name='is_approved', location=OpenApiParameter.QUERY, required=False, type=str),
+            OpenApiParameter(name='stream', location=OpenApiParameter.QUERY, required=False, type=bool,
+                             description='Stream the whole list as a chunked JSON array'),
+            OpenApiParameter(name='paginate', location=OpenApiParameter.QUERY, required=False, type=bool,
+                             description='Keyset pages ordered by id'),
+            OpenApiParameter(name='cursor', location=OpenApiParameter.QUERY, required=False, type=str),
+            OpenApiParameter(name='page_size', location=OpenApiParameter.QUERY, required=False, type=int),
+        ]
     )
     def get(self, request):
         # ?role={role}
@@ -39,6 +54,17 @@ class AdministrationUserList(APIView):
             queryset = queryset.filter(role__iexact=rolefilter.strip().lower())
         if approved_filter:
             queryset = queryset.filter(status__iexact=approved_filter.strip().lower())
+
+        if query_flag(request, 'stream'):
+            rows = json_array_stream(queryset.order_by('id'),
+                                     lambda chunk: AdminAllUsersSerializer(chunk, many=True).data)
+            return StreamingHttpResponse(rows, content_type='application/json')
+
+        if query_flag(request, 'paginate') or request.query_params.get('cursor'):
+            paginator = KeysetPagination(keyset_fields=('id',))
+            page = paginator.paginate_queryset(queryset, request)
+            return paginator.get_paginated_response(AdminAllUsersSerializer(page, many=True).data)
+
         users = AdminAllUsersSerializer(queryset, many=True)
         return Response(users.data)
 
@@ -120,6 +146,18 @@ class AdmCourseGetRedact(viewsets.ModelViewSet):
             course_role.save()
         return Response({"message":"user added to course successfully"},status=status.HTTP_200_OK)
 
+    @extend_schema(
+        summary="Bulk enroll users",
+        request=CourseBulkEnrollSerializer,
+        responses={200: OpenApiResponse(description='Outcome per user'), 400: OpenApiResponse(description='Bad Request')})
+    @action(detail=True, methods=['post'],url_path='bulkadd')
+    def bulk_add_users_to_course(self,request,pk):
+        course = self.get_course(pk)
+        serializer = CourseBulkEnrollSerializer(data=request.data, context={
+            'course': course, 'allowed_roles': ['student', 'co_lecturer', 'lecturer']})
+        serializer.is_valid(raise_exception=True)
+        return Response({"results": serializer.save()}, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['delete'],url_path='deleteuser')
     def remove_user_from_course(self,request,pk):
         course = self.get_course(pk)
@@ -158,6 +196,7 @@ class AdmCourseGetRedact(viewsets.ModelViewSet):
             return Response({"message":"User already has this role"},status=status.HTTP_400_BAD_REQUEST)
 
         CourseRoles.objects.filter(course=course,user=user_id).update(course_role=new_role)
+        transaction.on_commit(lambda: invalidate_course_roles(course.id, [user.id]))
         return Response({"message":"user changed role successfully"},status=status.HTTP_200_OK)
 
 
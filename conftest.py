@@ -1,10 +1,13 @@
 
 
 import pytest
+from django.core.cache import cache
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from courses_app.models import Course
+from courses_app.grading import _local_answer_keys, recount_test_totals
+from courses_app.models import Course, CourseRoles, CourseSections, SectionContent, TestBlock, TestQuestions, \
+    TestAnswers
 from main.models import SiteUser
 
 
@@ -13,6 +16,14 @@ def api_client():
     return APIClient()
 
 
+# cached outlines/roles/answer keys are keyed by ids that get reused between tests
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    _local_answer_keys.clear()
+    yield
+
+
 # scope for non-duplication
 @pytest.fixture
 def user_student(db):
@@ -88,3 +99,21 @@ def private_course(teacher_with_auth):
     print(f"[private_course] ID = {course.id}")
     return course
 
+@pytest.fixture
+def exam(user_teacher_approved, user_student):
+    # course with one test: single (1 pt), multiple (1 pt) and single (2 pts) questions
+    course = Course.objects.create(owner=user_teacher_approved, title='exam course', short_description='exam')
+    CourseRoles.objects.create(course=course, user=user_teacher_approved, course_role='lecturer')
+    CourseRoles.objects.create(course=course, user=user_student, course_role='student')
+    section = CourseSections.objects.create(course=course, section_name='exam', order=1)
+    block = SectionContent.objects.create(section=section, order=1, title='exam', content_type='test')
+    test = TestBlock.objects.create(section=block, test_title='exam', test_description='exam', possible_retries=3)
+    layout = [('single', 1, [True, False]), ('multiple', 1, [True, True, False]), ('single', 2, [False, True])]
+    for order, (answers_type, points, answers) in enumerate(layout, start=1):
+        question = TestQuestions.objects.create(test_block=test, order=order, test_question=f'q{order}',
+                                                test_answers_type=answers_type, max_points=points)
+        TestAnswers.objects.bulk_create([TestAnswers(test=question, order=i, answer_text=f'a{i}', is_correct=correct)
+                                         for i, correct in enumerate(answers, start=1)])
+    recount_test_totals(TestBlock.objects.filter(pk=test.pk))
+    test.refresh_from_db()
+    return test
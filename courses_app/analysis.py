@@ -0,0 +1,174 @@
+from dataclasses import dataclass
+from datetime import timedelta
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from courses_app.grading import get_answer_key
+from student_app.models import TestSession
+
+ITEM_ANALYSIS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+FOLD_BATCH_SESSIONS = 2000
+# sessions finishing right now may still be uncommitted, they are picked up by a later call
+SETTLE_DELAY = timedelta(seconds=30)
+
+
+@dataclass
+class ItemStats:
+    """
+    Additive sums over finished sessions, enough for p-values, point-biserials and
+    distractor rates, so new sessions are folded in without rereading old ones.
+    Arrays follow question_ids / answer_ids order.
+    """
+    question_ids: list
+    answer_ids: list
+    sessions: int = 0
+    sum_total: float = 0.0
+    sum_total_sq: float = 0.0
+    sum_item: np.ndarray = None
+    sum_item_sq: np.ndarray = None
+    sum_item_total: np.ndarray = None
+    selections: np.ndarray = None
+    # (finished_at, uuid) of the last session included
+    watermark: tuple = None
+
+    def __post_init__(self):
+        if self.sum_item is None:
+            self.sum_item = np.zeros(len(self.question_ids))
+            self.sum_item_sq = np.zeros(len(self.question_ids))
+            self.sum_item_total = np.zeros(len(self.question_ids))
+            self.selections = np.zeros(len(self.answer_ids), dtype=np.int64)
+
+
+def item_analysis_cache_key(test_block):
+    return f'item-analysis:{test_block.pk}:r{test_block.answer_key_revision}'
+
+
+def after_watermark(watermark):
+    finished_at, uuid = watermark
+    return Q(finished_at__gt=finished_at) | Q(finished_at=finished_at, uuid__gt=uuid)
+
+
+def new_session_rows(test_block, watermark, until):
+    """(uuid, finished_at, question_id, score, answer_id) of sessions finished after watermark, one query"""
+    sessions = TestSession.objects.filter(test_block=test_block, is_finished=True, finished_at__lte=until)
+    if watermark:
+        sessions = sessions.filter(after_watermark(watermark))
+    return sessions.order_by('finished_at', 'uuid') \
+        .values_list('uuid', 'finished_at', 'answers__question_id', 'answers__score', 'answers__selected_answers')
+
+
+def folded_sessions_drifted(test_block, stats):
+    """
+    finished_at is stamped before commit, so a session can become visible behind the watermark
+    (a slow transaction, a sweeper batch) or a folded one can go away. Both change how many
+    sessions sit at or before the watermark, which then no longer matches stats.sessions.
+    """
+    if not stats.watermark:
+        return False
+    folded = TestSession.objects.filter(test_block=test_block, is_finished=True) \
+        .exclude(after_watermark(stats.watermark)).count()
+    return folded != stats.sessions
+
+
+def fold_sessions(stats, key, rows):
+    """Adds the session x question score matrix of rows to stats"""
+    if not rows:
+        return stats
+    question_index = {question_id: i for i, question_id in enumerate(stats.question_ids)}
+    answer_index = {answer_id: i for i, answer_id in enumerate(stats.answer_ids)}
+    max_points = np.array([key[question_id].max_points or 1 for question_id in stats.question_ids], dtype=float)
+
+    session_index = {}
+    cells, scores, selected = [], [], []
+    for uuid, _, question_id, score, answer_id in rows:
+        row = session_index.setdefault(uuid, len(session_index))
+        if question_id in question_index:
+            cells.append((row, question_index[question_id]))
+            scores.append(score or 0)
+        if answer_id in answer_index:
+            selected.append(answer_index[answer_id])
+
+    matrix = np.zeros((len(session_index), len(stats.question_ids)))
+    if cells:
+        cells = np.array(cells)
+        matrix[cells[:, 0], cells[:, 1]] = scores
+    totals = matrix.sum(axis=1)
+    items = matrix / max_points
+
+    stats.sessions += len(session_index)
+    stats.sum_total += totals.sum()
+    stats.sum_total_sq += (totals ** 2).sum()
+    stats.sum_item += items.sum(axis=0)
+    stats.sum_item_sq += (items ** 2).sum(axis=0)
+    stats.sum_item_total += items.T @ totals
+    stats.selections += np.bincount(np.array(selected, dtype=np.int64), minlength=len(stats.answer_ids))
+    stats.watermark = (rows[-1][1], rows[-1][0])
+    return stats
+
+
+def session_batches(rows, batch_sessions=FOLD_BATCH_SESSIONS):
+    # rows of one session are adjacent, batches never split a session
+    batch, sessions, last_uuid = [], 0, None
+    for row in rows:
+        if row[0] != last_uuid:
+            if sessions == batch_sessions:
+                yield batch
+                batch, sessions = [], 0
+            sessions += 1
+            last_uuid = row[0]
+        batch.append(row)
+    if batch:
+        yield batch
+
+
+def describe(stats, key):
+    n = max(stats.sessions, 1)
+    mean_total = stats.sum_total / n
+    var_total = stats.sum_total_sq / n - mean_total ** 2
+    p_values = stats.sum_item / n
+    var_items = stats.sum_item_sq / n - p_values ** 2
+    covariance = stats.sum_item_total / n - p_values * mean_total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        point_biserial = covariance / np.sqrt(var_items * var_total)
+    rates = stats.selections / n
+
+    answer_position = {answer_id: i for i, answer_id in enumerate(stats.answer_ids)}
+    questions = []
+    for i, question_id in enumerate(stats.question_ids):
+        question = key[question_id]
+        questions.append({
+            'id': question_id,
+            'max_points': question.max_points,
+            'p_value': round(float(p_values[i]), 4) if stats.sessions else None,
+            'point_biserial': round(float(point_biserial[i]), 4) if np.isfinite(point_biserial[i]) else None,
+            'answers': [{'id': answer_id,
+                         'is_correct': bool(question.correct_mask & bit),
+                         'selection_rate': round(float(rates[answer_position[answer_id]]), 4)}
+                        for answer_id, bit in question.bits.items()],
+        })
+    return {'sessions': stats.sessions, 'mean_score': round(float(mean_total), 4), 'questions': questions}
+
+
+def item_analysis(test_block):
+    """
+    Item statistics of the test over all finished sessions, only sessions new since the cached run are read.
+    The sums are rebuilt from scratch when sessions showed up (or went away) behind the watermark.
+    """
+    key = get_answer_key(test_block)
+    cache_key = item_analysis_cache_key(test_block)
+    stats = cache.get(cache_key)
+    if stats is None or folded_sessions_drifted(test_block, stats):
+        question_ids = sorted(key)
+        stats = ItemStats(question_ids=question_ids,
+                          answer_ids=[answer_id for question_id in question_ids for answer_id in key[question_id].bits])
+
+    watermark = stats.watermark
+    rows = new_session_rows(test_block, watermark, timezone.now() - SETTLE_DELAY).iterator(chunk_size=10000)
+    for batch in session_batches(rows):
+        fold_sessions(stats, key, batch)
+    if stats.watermark != watermark:
+        cache.set(cache_key, stats, ITEM_ANALYSIS_CACHE_TIMEOUT)
+    return describe(stats, key)
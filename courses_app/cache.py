@@ -0,0 +1,41 @@
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from courses_app.models import CourseSections, SectionContent
+from courses_app.ordering import with_positions
+from courses_app.serializers import CourseSectionsGetSerializer, CourseSectionsOutlineSerializer
+from courses_app.utils import get_bookmarked_sections
+
+OUTLINE_CACHE_TIMEOUT = 60 * 60 * 24
+OUTLINE_BLOCK_FIELDS = ('id', 'order', 'content_type', 'title', 'section_id')
+
+
+def outline_cache_key(course, outline_only=False):
+    return f'course-outline:{course.pk}:v{course.content_version}{":nav" if outline_only else ""}'
+
+
+def get_course_outline(course, outline_only=False):
+    """
+    Sections tree of the course shared by every user.
+    Keyed by Course.content_version, so any content write makes old entries unreachable.
+    outline_only leaves block bodies out of both the query and the payload.
+    """
+    key = outline_cache_key(course, outline_only)
+    outline = cache.get(key)
+    if outline is None:
+        if outline_only:
+            blocks = SectionContent.objects.only(*OUTLINE_BLOCK_FIELDS)
+            serializer_class = CourseSectionsOutlineSerializer
+        else:
+            blocks = SectionContent.objects.defer('search_vector')
+            serializer_class = CourseSectionsGetSerializer
+        sections = with_positions(CourseSections.objects.filter(course=course)).prefetch_related(
+            Prefetch('section_content', queryset=blocks.order_by('order')))
+        outline = serializer_class(sections, many=True).data
+        cache.set(key, outline, OUTLINE_CACHE_TIMEOUT)
+    return outline
+
+
+def apply_user_overlay(outline, user, course):
+    bookmarked = get_bookmarked_sections(user, course)
+    return [{**section, 'bookmarked': section['id'] in bookmarked} for section in outline]
@@ -0,0 +1,53 @@
+import hashlib
+
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import OuterRef, Subquery, Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from courses_app.models import Course, SectionsBookmarks
+from student_app.models import TestSession
+
+
+def scalar(queryset, **aggregate):
+    # one aggregate over the rows of queryset as a subquery column
+    return Subquery(queryset.values('user').annotate(**aggregate).values(*aggregate)[:1])
+
+
+def course_content_validators(course, user, *variant, with_results=False):
+    """
+    Strong ETag and Last-Modified timestamp of a course content response for user.
+    Built from Course.content_version plus the user's bookmarks (and sessions) in one query.
+    """
+    bookmarks = SectionsBookmarks.objects.filter(user=user, section__course=OuterRef('pk'), is_bookmarked=True)
+    state = {'bookmarked_ids': scalar(bookmarks, ids=ArrayAgg('section_id', order_by='section_id'))}
+    if with_results:
+        sessions = TestSession.objects.filter(user=user, test_block__section__section__course=OuterRef('pk'))
+        state.update(session_count=scalar(sessions, count=Count('uuid')),
+                     last_started=scalar(sessions, started=Max('started_at')),
+                     last_finished=scalar(sessions, finished=Max('finished_at')),
+                     score_sum=scalar(sessions, score=Sum('summary_score')))
+    state = Course.objects.filter(pk=course.pk).values(**state).first() or {}
+
+    changes = [course.content_updated_at.timestamp()]
+    if state.get('last_finished'):
+        changes.append(state['last_finished'].timestamp())
+    parts = [course.pk, course.content_version, user.pk, *changes, *sorted(state.items()), *variant]
+    etag = quote_etag(hashlib.sha1(':'.join(map(str, parts)).encode()).hexdigest())
+    return etag, int(max(changes))
+
+
+def not_modified_response(request, etag, last_modified):
+    """304 (or 412) for matching preconditions, None when the body has to be built"""
+    # bookmark changes have no time of their own, so only the ETag decides
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
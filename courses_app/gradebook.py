@@ -0,0 +1,103 @@
+import csv
+import json
+import re
+from pathlib import Path
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import Max
+from django.utils import timezone
+
+from courses_app.models import CourseRoles, TestBlock
+from courses_app.streaming import STREAM_CHUNK_SIZE
+from student_app.models import TestSession
+
+GRADEBOOK_FORMATS = ('csv', 'ndjson')
+
+
+def gradebook_tests(course):
+    return list(TestBlock.objects.filter(section__section__course=course)
+                .order_by('section__section__order', 'section__order', 'id').values_list('id', 'test_title'))
+
+
+def gradebook_rows(course):
+    """
+    (user_id, username, {test_id: (best, latest)}) per student ordered by id.
+    Students and grades are two server-side cursors walked side by side, so only one student's
+    grades are held at a time.
+    """
+    students = CourseRoles.objects.filter(course=course, course_role='student').order_by('user_id') \
+        .values_list('user_id', 'user__username').iterator(chunk_size=STREAM_CHUNK_SIZE)
+    grades = TestSession.objects.filter(test_block__section__section__course=course, is_finished=True) \
+        .values('user_id', 'test_block_id') \
+        .annotate(best=Max('summary_score'), scores=ArrayAgg('summary_score', order_by='-finished_at')) \
+        .order_by('user_id', 'test_block_id') \
+        .values_list('user_id', 'test_block_id', 'best', 'scores').iterator(chunk_size=STREAM_CHUNK_SIZE)
+
+    grade = next(grades, None)
+    for user_id, username in students:
+        while grade is not None and grade[0] < user_id:
+            grade = next(grades, None)
+        results = {}
+        while grade is not None and grade[0] == user_id:
+            results[grade[1]] = (grade[2], grade[3][0])
+            grade = next(grades, None)
+        yield user_id, username, results
+
+
+class Echo:
+    # csv.writer target that hands every line back instead of buffering it
+    def write(self, value):
+        return value
+
+
+def csv_lines(course):
+    tests = gradebook_tests(course)
+    writer = csv.writer(Echo())
+    header = ['user_id', 'username']
+    for test_id, title in tests:
+        header += [f'{title} #{test_id} best', f'{title} #{test_id} latest']
+    yield writer.writerow(header)
+    for user_id, username, results in gradebook_rows(course):
+        row = [user_id, username]
+        for test_id, _ in tests:
+            row += results.get(test_id, ('', ''))
+        yield writer.writerow(row)
+
+
+def ndjson_lines(course):
+    for user_id, username, results in gradebook_rows(course):
+        yield json.dumps({'user_id': user_id, 'username': username,
+                          'tests': {test_id: {'best': best, 'latest': latest}
+                                    for test_id, (best, latest) in results.items()}}) + '\n'
+
+
+def gradebook_lines(course, export_format):
+    return csv_lines(course) if export_format == 'csv' else ndjson_lines(course)
+
+
+def gradebook_export_dir():
+    return Path(getattr(settings, 'GRADEBOOK_EXPORT_DIR', settings.BASE_DIR / 'exports'))
+
+
+def gradebook_file_name(course_id, export_format):
+    # the random suffix keeps two exports started in the same second apart
+    return f"gradebook-{course_id}-{timezone.now().strftime('%Y%m%d%H%M%S')}-{uuid4().hex[:8]}.{export_format}"
+
+
+def is_gradebook_file(course_id, file_name):
+    """Whether file_name is a finished export of the course as named by gradebook_file_name"""
+    formats = '|'.join(GRADEBOOK_FORMATS)
+    return re.fullmatch(rf'gradebook-{course_id}-\d{{14}}-[0-9a-f]{{8}}\.({formats})', file_name) is not None
+
+
+def write_gradebook(course, export_format, file_name):
+    """Writes the export next to a .part file first so a half written file is never served"""
+    path = gradebook_export_dir() / file_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part = path.with_name(path.name + '.part')
+    with open(part, 'w', newline='', encoding='utf-8') as file:
+        file.writelines(gradebook_lines(course, export_format))
+    part.rename(path)
+    return path
@@ -0,0 +1,190 @@
+import logging
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Count, Max, Avg
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from courses_app.leaderboard import record_session_score
+from courses_app.models import TestQuestions, TestBlock
+from courses_app.signals import bump_content_version, CONTENT_VERSION_LOOKUPS
+from student_app.answer_buffer import flush_session_buffer
+from student_app.models import TestUserAnswers, TestSession
+
+logger = logging.getLogger(__name__)
+
+# answer sets of a question are bitmasks, bit i is the i-th answer in display order
+QuestionKey = namedtuple('QuestionKey', ['max_points', 'correct_mask', 'bits'])
+
+ANSWER_KEY_CACHE_TIMEOUT = 60 * 60 * 24
+LOCAL_ANSWER_KEYS_LIMIT = 256
+# (test_block_id, revision) -> compiled key, shared by grading runs of one worker process
+_local_answer_keys = {}
+
+
+def compile_answer_key(test_block_id):
+    """{question_id: QuestionKey} of a test in one query"""
+    key = {}
+    rows = TestQuestions.objects.filter(test_block_id=test_block_id) \
+        .values_list('id', 'max_points', 'test_answers__id', 'test_answers__is_correct') \
+        .order_by('id', 'test_answers__order', 'test_answers__id')
+    for question_id, max_points, answer_id, is_correct in rows:
+        question = key.setdefault(question_id, QuestionKey(max_points or 0, 0, {}))
+        if answer_id is None:
+            continue
+        bit = 1 << len(question.bits)
+        question.bits[answer_id] = bit
+        if is_correct:
+            key[question_id] = question._replace(correct_mask=question.correct_mask | bit)
+    return key
+
+
+def answer_key_cache_key(test_block_id, revision):
+    return f'answer-key:{test_block_id}:r{revision}'
+
+
+def get_answer_key(test_block):
+    """
+    Compiled key of test_block at its current revision: process memory first,
+    then the shared cache, compiled from the answer tables only on a miss of both
+    """
+    marker = (test_block.pk, test_block.answer_key_revision)
+    key = _local_answer_keys.get(marker)
+    if key is not None:
+        return key
+    cache_key = answer_key_cache_key(*marker)
+    key = cache.get(cache_key)
+    if key is None:
+        key = compile_answer_key(test_block.pk)
+        cache.set(cache_key, key, ANSWER_KEY_CACHE_TIMEOUT)
+    if len(_local_answer_keys) >= LOCAL_ANSWER_KEYS_LIMIT:
+        _local_answer_keys.pop(next(iter(_local_answer_keys)))
+    _local_answer_keys[marker] = key
+    return key
+
+
+def record_question_change(test_block_id, questions=0, points=0):
+    """
+    Bumps the answer key revision and shifts the stored question_count / max_score by the given
+    deltas in one update, call it inside the transaction that changes the questions.
+    Also bumps the course content version once for the whole write.
+    """
+    # old revisions are never read again and expire from the caches on their own
+    TestBlock.objects.filter(pk=test_block_id).update(answer_key_revision=F('answer_key_revision') + 1,
+                                                      question_count=F('question_count') + questions,
+                                                      max_score=F('max_score') + points)
+    bump_content_version(**{CONTENT_VERSION_LOOKUPS[TestBlock]: test_block_id})
+
+
+def recount_test_totals(test_blocks):
+    """Recomputes question_count / max_score of the given TestBlock queryset, returns how many drifted"""
+    questions = TestQuestions.objects.filter(test_block=OuterRef('pk')).order_by().values('test_block')
+    drifted = test_blocks.annotate(
+        actual_score=Coalesce(Subquery(questions.annotate(total=Sum('max_points')).values('total')), 0),
+        actual_count=Coalesce(Subquery(questions.annotate(total=Count('id')).values('total')), 0),
+    ).exclude(max_score=F('actual_score'), question_count=F('actual_count'))
+    return TestBlock.objects.filter(pk__in=drifted.values('pk')).update(
+        max_score=Coalesce(Subquery(questions.annotate(total=Sum('max_points')).values('total')), 0),
+        question_count=Coalesce(Subquery(questions.annotate(total=Count('id')).values('total')), 0))
+
+
+def student_results(test_block):
+    """Attempts, best and mean score per student of the test, grouped in the database"""
+    return TestSession.objects.filter(test_block=test_block, is_finished=True).values('user_id') \
+        .annotate(username=F('user__username'), attempts=Count('uuid'), best_score=Max('summary_score'),
+                  mean_score=Avg('summary_score'), last_finished_at=Max('finished_at'))
+
+
+def results_summary(test_block):
+    summary = TestSession.objects.filter(test_block=test_block, is_finished=True).aggregate(
+        sessions=Count('uuid'), students=Count('user', distinct=True),
+        best_score=Max('summary_score'), mean_score=Avg('summary_score'))
+    summary['max_score'] = test_block.max_score
+    return summary
+
+
+def session_answer_rows(session):
+    """(user_answer_id, question_id, answer_id) per selected answer, answer_id is None for empty answers"""
+    return TestUserAnswers.objects.filter(session=session) \
+        .values_list('id', 'question_id', 'selected_answers')
+
+
+def score_answers(key, rows):
+    """Scores (user_answer_id, question_id, answer_id) rows against the key, returns {user_answer_id: score}"""
+    masks = {}
+    questions = {}
+    for user_answer_id, question_id, answer_id in rows:
+        questions[user_answer_id] = question_id
+        mask = masks.get(user_answer_id, 0)
+        if answer_id is not None and question_id in key:
+            mask |= key[question_id].bits.get(answer_id, 0)
+        masks[user_answer_id] = mask
+
+    scores = {}
+    for user_answer_id, mask in masks.items():
+        question = key.get(questions[user_answer_id])
+        scores[user_answer_id] = question.max_points if question and mask == question.correct_mask else 0
+    return scores
+
+
+def grade_session(session):
+    """
+    Grades every answer of the session: the answers are read in one query, compared as bitmasks
+    against the cached answer key and the scores written back with one bulk_update. Returns the total.
+    """
+    key = get_answer_key(session.test_block)
+    scores = score_answers(key, session_answer_rows(session))
+    TestUserAnswers.objects.bulk_update([TestUserAnswers(id=user_answer_id, score=score)
+                                         for user_answer_id, score in scores.items()], ['score'])
+    return sum(scores.values())
+
+
+def close_session(session):
+    """Grades and finishes a session the caller holds a row lock on"""
+    flush_session_buffer(session, final=True)
+    session.summary_score = grade_session(session)
+    session.is_finished = True
+    session.finished_at = timezone.now()
+    session.save(update_fields=['summary_score', 'is_finished', 'finished_at'])
+    record_session_score(session)
+    return session
+
+
+def finish_session(session_pk):
+    """
+    Finishes the session exactly once: the open row is locked first, so a manual submit and
+    the deadline sweeper can't both grade it. Returns None when it was already finished.
+    """
+    with transaction.atomic():
+        session = TestSession.objects.select_for_update(of=('self',)).select_related('test_block') \
+            .filter(pk=session_pk, is_finished=False).first()
+        if session is None:
+            return None
+        return close_session(session)
+
+
+def sweep_expired_sessions(batch_size=200):
+    """
+    Finishes open sessions past their deadline batch by batch, rows locked by others are skipped.
+    Each session is closed in its own savepoint, one that fails is logged and left for the next run.
+    """
+    finished, failed = 0, []
+    while True:
+        with transaction.atomic():
+            sessions = list(TestSession.objects.select_for_update(skip_locked=True, of=('self',))
+                            .select_related('test_block')
+                            .filter(is_finished=False, deadline_at__lte=timezone.now())
+                            .exclude(pk__in=failed)
+                            .order_by('deadline_at')[:batch_size])
+            for session in sessions:
+                try:
+                    with transaction.atomic():
+                        close_session(session)
+                    finished += 1
+                except Exception:
+                    logger.exception('Could not finish expired session %s', session.pk)
+                    failed.append(session.pk)
+        if len(sessions) < batch_size:
+            return finished
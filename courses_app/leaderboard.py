@@ -0,0 +1,111 @@
+from django.db import transaction
+from django.db.models import Exists, F, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import ValidationError
+
+from courses_app.models import CourseRoles, TestBlock
+from student_app.models import TestScore, CourseScore, TestSession
+
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_SIZE = 100
+
+
+def record_session_score(session):
+    """
+    Folds a just finished session into TestScore / CourseScore: the test row keeps the best score,
+    the course row grows by however much the best improved. Call it inside the finishing transaction.
+    """
+    course_id = TestBlock.objects.filter(pk=session.test_block_id) \
+        .values_list('section__section__course_id', flat=True).get()
+    score = session.summary_score or 0
+
+    entry, created = TestScore.objects.select_for_update().get_or_create(
+        test_block_id=session.test_block_id, user_id=session.user_id,
+        defaults={'course_id': course_id, 'best_score': score})
+    if created:
+        gain = score
+    else:
+        gain = max(score - entry.best_score, 0)
+        if gain:
+            entry.best_score = score
+            entry.save(update_fields=['best_score', 'updated_at'])
+
+    total, created = CourseScore.objects.get_or_create(course_id=course_id, user_id=session.user_id,
+                                                      defaults={'total_score': gain})
+    if gain and not created:
+        CourseScore.objects.filter(pk=total.pk).update(total_score=F('total_score') + gain)
+
+
+def refresh_course_score(course_id, user_id):
+    """Resets the user's CourseScore to the sum of their remaining TestScores, safe to repeat"""
+    total = TestScore.objects.filter(course_id=course_id, user_id=user_id).order_by() \
+        .values('user_id').annotate(total=Sum('best_score')).values('total')
+    CourseScore.objects.filter(course_id=course_id, user_id=user_id) \
+        .update(total_score=Coalesce(Subquery(total), 0.0))
+
+
+def refresh_test_score(test_block_id, user_id):
+    """Recomputes the user's TestScore of a test from the finished sessions left, after one was deleted"""
+    entry = TestScore.objects.filter(test_block_id=test_block_id, user_id=user_id).first()
+    if entry is None:
+        return
+    best = TestSession.objects.filter(test_block_id=test_block_id, user_id=user_id, is_finished=True) \
+        .aggregate(best=Max('summary_score'))['best']
+    if best is None:
+        # the post_delete signal of TestScore refreshes the course total
+        entry.delete()
+    elif best != entry.best_score:
+        entry.best_score = best
+        entry.save(update_fields=['best_score', 'updated_at'])
+        refresh_course_score(entry.course_id, user_id)
+
+
+def rebuild_scores(courses):
+    """Recomputes TestScore and CourseScore of the given Course queryset from finished sessions"""
+    with transaction.atomic():
+        TestScore.objects.filter(course__in=courses).delete()
+        CourseScore.objects.filter(course__in=courses).delete()
+        best = TestSession.objects.filter(test_block__section__section__course__in=courses, is_finished=True) \
+            .values('test_block_id', 'user_id') \
+            .annotate(course_id=F('test_block__section__section__course_id'), best=Max('summary_score'))
+        TestScore.objects.bulk_create([TestScore(test_block_id=row['test_block_id'], user_id=row['user_id'],
+                                                 course_id=row['course_id'], best_score=row['best'] or 0)
+                                       for row in best], batch_size=2000)
+        totals = TestScore.objects.filter(course__in=courses).values('course_id', 'user_id') \
+            .annotate(total=Sum('best_score'))
+        CourseScore.objects.bulk_create([CourseScore(course_id=row['course_id'], user_id=row['user_id'],
+                                                     total_score=row['total']) for row in totals], batch_size=2000)
+
+
+def leaderboard_size(request):
+    try:
+        size = int(request.query_params.get('limit', LEADERBOARD_SIZE))
+    except (TypeError, ValueError):
+        raise ValidationError({'limit': 'Must be an integer'})
+    return max(1, min(size, MAX_LEADERBOARD_SIZE))
+
+
+def leaderboard(entries, score_field, user, limit=LEADERBOARD_SIZE):
+    """
+    Top entries and the user's rank / percentile among entries (TestScore or CourseScore rows of
+    one test or course) of current course members. Every read is a range of the (scope, score desc)
+    index probed against CourseRoles; equal scores share a rank.
+    """
+    # scores stay when a student leaves, so a rejoin keeps them, but only members are ranked
+    entries = entries.filter(Exists(CourseRoles.objects.filter(course=OuterRef('course'), user=OuterRef('user'))))
+    top = list(entries.order_by(f'-{score_field}', 'updated_at', 'user_id')
+               .values_list('user_id', 'user__username', score_field)[:limit])
+    rows, rank = [], 0
+    for position, (user_id, username, score) in enumerate(top, start=1):
+        if not rows or score != rows[-1]['score']:
+            rank = position
+        rows.append({'rank': rank, 'user_id': user_id, 'username': username, 'score': score})
+
+    participants = entries.count()
+    me = None
+    own_score = entries.filter(user=user).values_list(score_field, flat=True).first()
+    if own_score is not None:
+        higher = entries.filter(**{f'{score_field}__gt': own_score}).count()
+        me = {'rank': higher + 1, 'score': own_score,
+              'percentile': round(100 * (participants - higher) / participants, 1)}
+    return {'participants': participants, 'top': rows, 'me': me}
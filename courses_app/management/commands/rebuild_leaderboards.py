@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from courses_app.leaderboard import rebuild_scores
+from courses_app.models import Course
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds TestScore and CourseScore leaderboard rows from finished test sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_ids', nargs='*', type=int, help='only these courses')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.all()
+        if options['course_ids']:
+            courses = courses.filter(pk__in=options['course_ids'])
+        rebuild_scores(courses)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt leaderboards of {courses.count()} courses'))
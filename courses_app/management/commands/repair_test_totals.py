@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from courses_app.grading import recount_test_totals
+from courses_app.models import TestBlock
+
+
+class Command(BaseCommand):
+    help = 'Recomputes TestBlock.max_score and question_count from the questions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('test_ids', nargs='*', type=int, help='only these test blocks')
+
+    def handle(self, *args, **options):
+        test_blocks = TestBlock.objects.all()
+        if options['test_ids']:
+            test_blocks = test_blocks.filter(pk__in=options['test_ids'])
+        repaired = recount_test_totals(test_blocks)
+        self.stdout.write(self.style.SUCCESS(f'Repaired {repaired} test blocks'))
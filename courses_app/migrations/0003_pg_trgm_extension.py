@@ -0,0 +1,13 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses_app', '0002_alter_course_course_accessibility'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+    ]
@@ -1,5 +1,9 @@
 from datetime import timedelta
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.utils import timezone
+
 from main.models import *
 
 # Create your models here.
@@ -16,6 +20,13 @@ class Course(models.Model):
                                 ('on_invite_only', 'on_invite_only'),
                                 ('on_requests', 'on_requests')],default='public')
     created_at = models.DateTimeField(auto_now_add=True)
+    # bumped on every write to sections/blocks/tests, see courses_app.signals
+    content_version = models.PositiveIntegerField(default=0)
+    content_updated_at = models.DateTimeField(default=timezone.now)
+    search_vector = models.GeneratedField(
+        expression=SearchVector('title', weight='A', config='english')
+                   + SearchVector('short_description', weight='B', config='english'),
+        output_field=SearchVectorField(), db_persist=True)
     #learn_sections -->
     def __str__(self):
         return f"{self.title}  {self.short_description} - {self.owner}  - {CourseRoles.course_role}"
@@ -55,6 +66,13 @@ class Course(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='course_created_id_idx'),
+            models.Index(fields=['course_accessibility', 'created_at', 'id'], name='course_access_created_idx'),
+            GinIndex(fields=['search_vector'], name='course_search_idx'),
+            # pg_trgm, serves istartswith/icontains for autocomplete
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='course_title_trgm_idx'),
+        ]
 
 
 class CourseJoinRequests(models.Model):
@@ -86,6 +104,7 @@ class CourseRoles(models.Model):
 
 
 class CourseSections(models.Model):
+    # sparse rank, see courses_app.ordering
     order = models.PositiveIntegerField()
     section_name = models.CharField(max_length=22)
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='course_sections')
@@ -94,7 +113,11 @@ class CourseSections(models.Model):
         return f"{self.id} - {self.section_name} -{self.course.title}"
     class Meta:
         ordering = ['order']
-        unique_together = ('course','order')
+        # deferred so a reorder can renumber every sibling in one UPDATE, see courses_app.ordering
+        constraints = [
+            models.UniqueConstraint(fields=['course', 'order'], name='unique_section_order',
+                                    deferrable=models.Deferrable.DEFERRED),
+        ]
 
 class SectionContent(models.Model):
     order = models.PositiveIntegerField()
@@ -103,10 +126,21 @@ class SectionContent(models.Model):
                                              ('test','test')],default='lection')
     title = models.CharField(max_length=22)
     content = models.TextField()
+    search_vector = models.GeneratedField(
+        expression=SearchVector('title', weight='A', config='english')
+                   + SearchVector('content', weight='B', config='english'),
+        output_field=SearchVectorField(), db_persist=True)
 
     class Meta:
         ordering = ['order']
-        unique_together = ('section','order')
+        constraints = [
+            models.UniqueConstraint(fields=['section', 'order'], name='unique_block_order',
+                                    deferrable=models.Deferrable.DEFERRED),
+        ]
+        indexes = [
+            GinIndex(fields=['search_vector'], name='section_content_search_idx'),
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='section_content_title_trgm_idx'),
+        ]
 
 
 class TestBlock(models.Model):
@@ -115,6 +149,10 @@ class TestBlock(models.Model):
     test_description = models.TextField()
     time_for_test = models.DurationField(default=timedelta(minutes=15))
     possible_retries = models.PositiveIntegerField(default=0)
+    answer_key_revision = models.PositiveIntegerField(default=0)
+    # kept in step with the questions by record_question_change, see repair_test_totals
+    max_score = models.IntegerField(default=0)
+    question_count = models.PositiveIntegerField(default=0)
 
 
 class TestQuestions(models.Model):
@@ -127,6 +165,9 @@ class TestQuestions(models.Model):
 
     class Meta:
         ordering = ['order']
+        indexes = [
+            models.Index(fields=['test_block', 'order'], name='question_order_idx'),
+        ]
 
 
 class TestAnswers(models.Model):
@@ -137,7 +178,10 @@ class TestAnswers(models.Model):
 
     class Meta:
         ordering = ['order']
-        unique_together = ('test','order')
+        constraints = [
+            models.UniqueConstraint(fields=['test', 'order'], name='unique_answer_order',
+                                    deferrable=models.Deferrable.DEFERRED),
+        ]
 
 
 class SectionsBookmarks(models.Model):
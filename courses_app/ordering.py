@@ -0,0 +1,249 @@
+from django.db import transaction
+from django.db.models import Case, When, Value, F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import RowNumber
+from django.db.models.manager import BaseManager
+from django.http import Http404
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+from courses_app.models import CourseSections, SectionContent, TestQuestions
+from courses_app.signals import bump_content_version, CONTENT_VERSION_LOOKUPS
+
+# Sections, blocks and questions store a sparse rank in `order`: new items go ORDER_GAP after
+# the last one or halfway between two neighbours, so inserting never renumbers the siblings.
+# Responses show the dense 1..n position instead (PositionField).
+ORDER_GAP = 1024
+RANKED_PARENTS = {
+    CourseSections: 'course',
+    SectionContent: 'section',
+    TestQuestions: 'test_block',
+}
+
+
+def order_step(model):
+    # answers keep client-managed dense orders
+    return ORDER_GAP if model in RANKED_PARENTS else 1
+
+
+def siblings_of(model, parent_id):
+    return model.objects.filter(**{f'{RANKED_PARENTS[model]}_id': parent_id})
+
+
+def with_positions(queryset):
+    """Annotates the dense position, only correct when the queryset holds every sibling"""
+    parent = RANKED_PARENTS[queryset.model]
+    return queryset.annotate(position=Window(RowNumber(), partition_by=F(parent),
+                                             order_by=[F('order').asc(), F('id').asc()]))
+
+
+def sibling_position(obj):
+    position = getattr(obj, 'position', None)
+    if position is None:
+        model = type(obj)
+        parent_id = getattr(obj, f'{RANKED_PARENTS[model]}_id')
+        # same (order, id) ordering as with_positions
+        position = siblings_of(model, parent_id).filter(
+            Q(order__lt=obj.order) | Q(order=obj.order, id__lt=obj.id)).count() + 1
+    return position
+
+
+def sibling_at(siblings, position):
+    """The sibling at a 1-based position, 404 when there is none"""
+    try:
+        position = int(position)
+    except (TypeError, ValueError):
+        raise ValidationError('Position must be an integer')
+    found = list(siblings.order_by('order', 'id')[position - 1:position]) if position > 0 else []
+    if not found:
+        raise Http404('Nothing at this position')
+    found[0].position = position
+    return found[0]
+
+
+def renumber(siblings, ordered_ids):
+    """Spreads the siblings over evenly spaced ranks in the order of ordered_ids with a single UPDATE"""
+    step = order_step(siblings.model)
+    siblings.filter(pk__in=ordered_ids).update(order=Case(
+        *[When(pk=pk, then=Value(position * step)) for position, pk in enumerate(ordered_ids, start=1)]))
+
+
+def apply_order(siblings, ordered_ids):
+    """
+    Puts the siblings in the order of ordered_ids with a single UPDATE.
+    Intermediate duplicates are fine, the (parent, order) unique constraints are checked at commit.
+    """
+    if not ordered_ids:
+        return
+    with transaction.atomic():
+        renumber(siblings, ordered_ids)
+        # .update() skips the post_save signals that version the content
+        bump_content_version(**{CONTENT_VERSION_LOOKUPS[siblings.model]: ordered_ids[0]})
+
+
+def lock_parent(model, parent_id):
+    # inserts and rebalances under one parent queue up on its row
+    parent_model = model._meta.get_field(RANKED_PARENTS[model]).related_model
+    return parent_model.objects.select_for_update().filter(pk=parent_id)
+
+
+def rebalance(model, parent_id):
+    """Respaces the ranks of one parent's children, positions don't change"""
+    with transaction.atomic():
+        list(lock_parent(model, parent_id).values_list('pk', flat=True))
+        siblings = siblings_of(model, parent_id)
+        renumber(siblings, list(siblings.order_by('order', 'id').values_list('id', flat=True)))
+
+
+def schedule_rebalance(model, parent_id):
+    from Learning_platform.tasks import rebalance_order_keys
+    label = model._meta.label
+    transaction.on_commit(lambda: rebalance_order_keys.delay(label, parent_id))
+
+
+def rank_between(before_rank, after_rank):
+    """A free rank strictly between two neighbours (None for an open end), None when there is no room"""
+    low = before_rank or 0
+    if after_rank is None:
+        return low + ORDER_GAP
+    if after_rank - low < 2:
+        return None
+    return (low + after_rank) // 2
+
+
+def insert_rank(model, parent_id, position=None):
+    """
+    Rank for a new child of parent_id at a 1-based position, appended when position is None or
+    past the end. Locks the parent row, so concurrent inserts under the same parent queue up
+    instead of picking the same rank. Call it inside the inserting transaction.
+    """
+    last = Subquery(model.objects.filter(**{RANKED_PARENTS[model]: OuterRef('pk')})
+                    .order_by('-order').values('order')[:1])
+    last_rank = lock_parent(model, parent_id).values_list(last, flat=True).first()
+    if position is None or position < 1:
+        return (last_rank or 0) + ORDER_GAP
+
+    for attempt in range(2):
+        # ranks of the items that end up right before and right after the new one
+        ranks = list(siblings_of(model, parent_id).order_by('order')
+                     .values_list('order', flat=True)[max(position - 2, 0):position])
+        if position == 1:
+            before_rank, after_rank = None, (ranks[0] if ranks else None)
+        elif not ranks:
+            return (last_rank or 0) + ORDER_GAP
+        else:
+            before_rank, after_rank = ranks[0], (ranks[1] if len(ranks) > 1 else None)
+        rank = rank_between(before_rank, after_rank)
+        if rank is not None:
+            if after_rank is not None and min(rank - (before_rank or 0), after_rank - rank) < 2:
+                # the gap is used up, respace the siblings before the next insert lands here
+                schedule_rebalance(model, parent_id)
+            return rank
+        rebalance(model, parent_id)
+    raise ValidationError('Could not find a free position')
+
+
+class PositionField(serializers.ReadOnlyField):
+    """Dense 1..n position of a section, block or question among its siblings"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', '*')
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return sibling_position(value)
+
+
+class PositionedListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        if isinstance(data, BaseManager):
+            # a related set is every sibling in rank order, so positions are just the indexes
+            data = list(data.all())
+            for position, item in enumerate(data, start=1):
+                item.position = position
+        return super().to_representation(data)
+
+
+def moved_order(ordered_ids, move, before=None):
+    """ordered_ids with move placed right before `before`, or at the end when before is None"""
+    ordered_ids = [pk for pk in ordered_ids if pk != move]
+    position = ordered_ids.index(before) if before is not None else len(ordered_ids)
+    ordered_ids.insert(position, move)
+    return ordered_ids
+
+
+def swap_ranks(first, second):
+    """Exchanges the ranks of two siblings in one UPDATE"""
+    model = type(first)
+    with transaction.atomic():
+        model.objects.filter(pk__in=[first.pk, second.pk]).update(order=Case(
+            When(pk=first.pk, then=Value(second.order)), When(pk=second.pk, then=Value(first.order))))
+        bump_content_version(**{CONTENT_VERSION_LOOKUPS[model]: first.pk})
+    first.order, second.order = second.order, first.order
+
+
+class ReorderSerializer(serializers.Serializer):
+    """
+    Either the full desired order as a list of ids, or one `move` id placed before the `before` id
+    (at the end when before is null). context['siblings'] is the queryset being reordered.
+    """
+    order = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=10000)
+    move = serializers.IntegerField(required=False)
+    before = serializers.IntegerField(required=False, allow_null=True)
+
+    def ordered_ids(self, data, current):
+        """The requested order of the current (id, rank) rows"""
+        ids = [pk for pk, _ in current]
+        if 'order' in data:
+            if len(data['order']) != len(ids) or set(data['order']) != set(ids):
+                raise ValidationError({'order': 'Must list every item exactly once'})
+            return data['order']
+        before = data.get('before')
+        if data['move'] not in ids or (before is not None and before not in ids):
+            raise ValidationError({'move': 'Item not found'})
+        return moved_order(ids, data['move'], before)
+
+    def validate(self, data):
+        if 'order' in data and 'move' in data:
+            raise ValidationError('Send either order or move, not both')
+        if 'order' not in data and 'move' not in data:
+            raise ValidationError('Send either order or move')
+        if data.get('before') is not None and data.get('before') == data.get('move'):
+            raise ValidationError({'before': 'Item can\'t be moved before itself'})
+        self.ordered_ids(data, self.current_ranks())
+        return data
+
+    def current_ranks(self):
+        return list(self.context['siblings'].order_by('order', 'id').values_list('id', 'order'))
+
+    def save(self, **kwargs):
+        siblings = self.context['siblings']
+        model = siblings.model
+        with transaction.atomic():
+            if model in RANKED_PARENTS:
+                # concurrent moves and inserts under the parent queue up, the ranks are read after the lock
+                parent_id = siblings.values_list(f'{RANKED_PARENTS[model]}_id', flat=True).first()
+                list(lock_parent(model, parent_id).values_list('pk', flat=True))
+            current = self.current_ranks()
+            ordered_ids = self.ordered_ids(self.validated_data, current)
+            if 'move' in self.validated_data and model in RANKED_PARENTS:
+                self.move_into_gap(siblings, parent_id, dict(current), ordered_ids)
+            else:
+                apply_order(siblings, ordered_ids)
+        if model in RANKED_PARENTS:
+            return with_positions(siblings.order_by('order'))
+        return siblings.order_by('order')
+
+    def move_into_gap(self, siblings, parent_id, ranks, ordered_ids):
+        """One row moves into the gap between its new neighbours, all are respaced when there is no room"""
+        move = self.validated_data['move']
+        index = ordered_ids.index(move)
+        before_rank = ranks[ordered_ids[index - 1]] if index else None
+        after_rank = ranks[ordered_ids[index + 1]] if index + 1 < len(ordered_ids) else None
+        rank = rank_between(before_rank, after_rank)
+        if rank is None:
+            apply_order(siblings, ordered_ids)
+            return
+        siblings.filter(pk=move).update(order=rank)
+        bump_content_version(**{CONTENT_VERSION_LOOKUPS[siblings.model]: move})
+        if after_rank is not None and min(rank - (before_rank or 0), after_rank - rank) < 2:
+            schedule_rebalance(siblings.model, parent_id)
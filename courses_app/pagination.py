@@ -0,0 +1,78 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique ordered key, e.g. (created_at, id).
+    The cursor holds the key of the last row of the page, so every page is
+    one indexed range scan no matter how deep the client goes.
+    """
+    keyset_fields = ('id',)
+    page_size = 20
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def __init__(self, keyset_fields=None):
+        if keyset_fields:
+            self.keyset_fields = tuple(keyset_fields)
+        self.next_cursor = None
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            raise ValidationError({self.page_size_query_param: 'Must be an integer'})
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, obj):
+        # rows of .values() querysets are dicts
+        values = [str(obj[field] if isinstance(obj, dict) else getattr(obj, field)) for field in self.keyset_fields]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, queryset, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            if len(values) != len(self.keyset_fields):
+                raise ValueError
+            opts = queryset.model._meta
+            return [opts.get_field(field).to_python(value) for field, value in zip(self.keyset_fields, values)]
+        except Exception:
+            raise ValidationError({self.cursor_query_param: 'Invalid cursor'})
+
+    def keyset_filter(self, values):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        condition = Q()
+        for i, field in enumerate(self.keyset_fields):
+            step = Q(**{f'{field}__gt': values[i]})
+            for prev_field, prev_value in zip(self.keyset_fields[:i], values[:i]):
+                step &= Q(**{prev_field: prev_value})
+            condition |= step
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.keyset_fields)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.keyset_filter(self.decode_cursor(queryset, cursor)))
+
+        page = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_cursor = self.encode_cursor(page[-1])
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.next_cursor,
+            'results': data,
+        })
@@ -0,0 +1,59 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchHeadline
+from django.db.models import Exists, OuterRef, Q, F
+from django.db.models.functions import Length
+
+from courses_app.models import Course, CourseRoles, SectionContent
+
+SEARCH_CONFIG = 'english'
+
+
+def is_staff(user):
+    return user.role == 'staff' or user.is_superuser
+
+
+def visible_courses(user):
+    # public courses plus the ones the user has a role in
+    courses = Course.objects.all()
+    if is_staff(user):
+        return courses
+    return courses.filter(Q(course_accessibility='public')
+                          | Exists(CourseRoles.objects.filter(course=OuterRef('pk'), user=user)))
+
+
+def readable_blocks(user):
+    # block contents are only readable inside joined courses
+    blocks = SectionContent.objects.select_related('section')
+    if is_staff(user):
+        return blocks
+    return blocks.filter(section__course_id__in=CourseRoles.objects.filter(user=user).values('course_id'))
+
+
+def search_courses(user, text, limit):
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    return visible_courses(user).filter(search_vector=query) \
+        .annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', 'id')[:limit]
+
+
+def search_blocks(user, text, limit):
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    return readable_blocks(user).filter(search_vector=query) \
+        .annotate(rank=SearchRank(F('search_vector'), query),
+                  headline=SearchHeadline('content', query, config=SEARCH_CONFIG, max_words=30, min_words=10)) \
+        .order_by('-rank', 'id')[:limit]
+
+
+def title_prefix_filter(text):
+    # matches the beginning of any word of the title, served by the trigram index
+    return Q(title__istartswith=text) | Q(title__icontains=f' {text}')
+
+
+def autocomplete(user, text, limit):
+    courses = visible_courses(user).filter(title_prefix_filter(text)) \
+        .order_by(Length('title'), 'id').values('id', 'title')[:limit]
+    blocks = readable_blocks(user).filter(title_prefix_filter(text)) \
+        .order_by(Length('title'), 'id').values('id', 'title', 'section_id', 'section__course_id')[:limit]
+    return {
+        'courses': list(courses),
+        'blocks': [{'id': b['id'], 'title': b['title'], 'section_id': b['section_id'],
+                    'course_id': b['section__course_id']} for b in blocks],
+    }
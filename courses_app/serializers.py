@@ -3,7 +3,9 @@ from rest_framework import serializers
 from rest_framework.fields import SerializerMethodField
 
 from courses_app.models import Course, CourseSections, SectionContent, CourseJoinRequests, TestQuestions, TestBlock, \
-    CourseRoles
+    CourseRoles, SectionsBookmarks
+from courses_app.ordering import PositionField, PositionedListSerializer, insert_rank, siblings_of, ORDER_GAP
+from courses_app.utils import invalidate_course_roles
 from main.models import SiteUser
 from teacher_app.serializers import TestBlockGetUpdateSerializer, AdminTestBlockSerializer, \
     ShortTestSessionResultsSerializer
@@ -21,13 +23,39 @@ class CourseSerializer(serializers.ModelSerializer):
             'id': u.user.id,
             'username': u.user.username,
             'role': u.course_role
-        } for u in obj.course_roles.select_related('user') ]
+        } for u in obj.course_roles.all() ]
 
     def create(self, validated_data):
         owner = self.context['request'].user
         validated_data['owner'] = owner
         return Course.objects.create(**validated_data)
 
+class CourseCatalogSerializer(serializers.ModelSerializer):
+    members_count = serializers.IntegerField(read_only=True)
+    class Meta:
+        model = Course
+        fields = ('id','owner','title','short_description','created_at','course_accessibility','members_count',)
+        read_only_fields = fields
+
+
+class CourseSearchResultSerializer(serializers.ModelSerializer):
+    rank = serializers.FloatField(read_only=True)
+    class Meta:
+        model = Course
+        fields = ('id','owner','title','short_description','course_accessibility','rank',)
+        read_only_fields = fields
+
+
+class SectionContentSearchResultSerializer(serializers.ModelSerializer):
+    course_id = serializers.IntegerField(source='section.course_id', read_only=True)
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.CharField(read_only=True)
+    class Meta:
+        model = SectionContent
+        fields = ('id','course_id','section_id','content_type','title','headline','rank',)
+        read_only_fields = fields
+
+
 class CourseRoleSerializer(serializers.ModelSerializer):
     class Meta:
         model = CourseRoles
@@ -111,6 +139,56 @@ class CourseUserKickSerializer(serializers.Serializer):
         return {"message":"User has been deleted from this course"}
 
 
+class BulkEnrollEntrySerializer(serializers.Serializer):
+    user_id = serializers.IntegerField()
+    role = serializers.ChoiceField(choices=['student', 'co_lecturer', 'lecturer'], default='student')
+
+
+class CourseBulkEnrollSerializer(serializers.Serializer):
+    users = BulkEnrollEntrySerializer(many=True, allow_empty=False, max_length=5000)
+
+    def validate_users(self, value):
+        allowed_roles = self.context.get('allowed_roles', ['student', 'co_lecturer'])
+        forbidden = sorted({entry['role'] for entry in value} - set(allowed_roles))
+        if forbidden:
+            raise serializers.ValidationError(f'Roles {forbidden} can not be assigned here')
+        return value
+
+    def save(self, **kwargs):
+        """Enrolls the whole list in a fixed number of statements, returns outcome per user"""
+        course = self.context.get('course')
+        entries = {}
+        outcomes = []
+        for entry in self.validated_data['users']:
+            if entry['user_id'] in entries:
+                outcomes.append({'user_id': entry['user_id'], 'status': 'duplicate'})
+                continue
+            entries[entry['user_id']] = entry['role']
+
+        with transaction.atomic():
+            existing_users = set(SiteUser.objects.filter(id__in=entries).values_list('id', flat=True))
+            enrolled = set(CourseRoles.objects.filter(course=course, user_id__in=existing_users)
+                           .values_list('user_id', flat=True))
+            new_users = [user_id for user_id in entries if user_id in existing_users and user_id not in enrolled]
+
+            Membership = Course.users.through
+            Membership.objects.bulk_create([Membership(course_id=course.id, siteuser_id=user_id)
+                                            for user_id in new_users], ignore_conflicts=True)
+            CourseRoles.objects.bulk_create([CourseRoles(course=course, user_id=user_id, course_role=entries[user_id])
+                                             for user_id in new_users], ignore_conflicts=True)
+        # bulk_create skips the post_save signal
+        transaction.on_commit(lambda: invalidate_course_roles(course.id, new_users))
+
+        for user_id, role in entries.items():
+            if user_id not in existing_users:
+                outcomes.append({'user_id': user_id, 'status': 'not_found'})
+            elif user_id in enrolled:
+                outcomes.append({'user_id': user_id, 'status': 'already_enrolled'})
+            else:
+                outcomes.append({'user_id': user_id, 'status': 'enrolled', 'role': role})
+        return outcomes
+
+
 class CourseMiniForAdminSerializer(serializers.ModelSerializer):
     user_role = serializers.SerializerMethodField()
     class Meta:
@@ -118,6 +196,9 @@ class CourseMiniForAdminSerializer(serializers.ModelSerializer):
         fields = ['id','owner','title','user_role']
 
     def get_user_role(self, course):
+        user_roles = self.context.get('user_roles')
+        if user_roles is not None:
+            return user_roles.get(course.pk)
         user = self.context.get('target_user')
         if not user:
             return None
@@ -144,20 +225,45 @@ class CourseMiniSerializer(serializers.ModelSerializer):
 
 
 class SectionContentSerializer(serializers.ModelSerializer):
+    order = PositionField()
+
     class Meta:
         model = SectionContent
         fields = ('id','order','content_type', 'title', 'content')
+        list_serializer_class = PositionedListSerializer
 
 
 class CourseSectionsGetSerializer(serializers.ModelSerializer):
+    order = PositionField()
     section_content = SectionContentSerializer(many=True, read_only=True)
     bookmarked = serializers.SerializerMethodField()
     class Meta:
         model = CourseSections
         fields = ('id','order','section_name','section_content','bookmarked')
+        list_serializer_class = PositionedListSerializer
 
     def get_bookmarked(self, obj):
-        return obj.sections_bookmarks.filter(user=self.context.get('user'),is_bookmarked=True).exists()
+        bookmarked = self.context.get('bookmarked_sections')
+        if bookmarked is not None:
+            return obj.id in bookmarked
+        user = self.context.get('user')
+        if user is None:
+            return False
+        return obj.sections_bookmarks.filter(user=user,is_bookmarked=True).exists()
+
+
+class SectionContentOutlineSerializer(serializers.ModelSerializer):
+    order = PositionField()
+
+    class Meta:
+        model = SectionContent
+        fields = ('id','order','content_type', 'title')
+        list_serializer_class = PositionedListSerializer
+
+
+class CourseSectionsOutlineSerializer(CourseSectionsGetSerializer):
+    """Navigation only: block bodies and tests are loaded from the block endpoint"""
+    section_content = SectionContentOutlineSerializer(many=True, read_only=True)
 
 
 class CourseDataGetSerializer(serializers.ModelSerializer):
@@ -167,46 +273,95 @@ class CourseDataGetSerializer(serializers.ModelSerializer):
         fields = ('id', 'title', 'short_description', 'created_at', 'course_accessibility', 'course_sections',)
 
 
+class CourseDataCachedSerializer(serializers.ModelSerializer):
+    """CourseDataGetSerializer output with sections from the shared outline cache"""
+    course_sections = serializers.SerializerMethodField()
+    class Meta:
+        model = Course
+        fields = ('id', 'title', 'short_description', 'created_at', 'course_accessibility', 'course_sections',)
+
+    def get_course_sections(self, obj):
+        from courses_app.cache import get_course_outline, apply_user_overlay
+        outline = get_course_outline(obj, outline_only=self.context.get('outline_only', False))
+        return apply_user_overlay(outline, self.context.get('user'), obj)
+
+
 class SectionContentMultiSerializer(serializers.ModelSerializer):
+    order = PositionField()
     test_block = serializers.SerializerMethodField()
 
     class Meta:
         model = SectionContent
         fields = ['id', 'order', 'content_type', 'title', 'content', 'test_block']
+        list_serializer_class = PositionedListSerializer
 
     def get_test_block(self, obj):
         if obj.content_type == 'test':
             test_block = TestBlock.objects.filter(section=obj).first()
             if test_block:
-                return TestBlockGetUpdateSerializer(test_block).data
+                # the block already knows its position
+                test_block.section = obj
+                return TestBlockGetUpdateSerializer(test_block, context=self.context).data
         return []
 
 class AdminSectionContentMultiSerializer(serializers.ModelSerializer):
+    order = PositionField()
     test_block = serializers.SerializerMethodField()
 
     class Meta:
         model = SectionContent
         fields = ['id', 'order', 'content_type', 'title', 'content', 'test_block']
+        list_serializer_class = PositionedListSerializer
 
     def get_test_block(self, obj):
         if obj.content_type == 'test':
             test_block = TestBlock.objects.filter(section=obj).first()
             if test_block:
-                return AdminTestBlockSerializer(test_block).data
+                test_block.section = obj
+                return AdminTestBlockSerializer(test_block, context=self.context).data
         return None
 
 
 class CourseSectionsSerializer(serializers.ModelSerializer):
+    order = PositionField()
     section_content = SectionContentMultiSerializer(many=True, read_only=True)
     bookmarked = serializers.SerializerMethodField()
     class Meta:
         model = CourseSections
         fields = ('id','order','section_name','section_content','bookmarked')
+        list_serializer_class = PositionedListSerializer
 
     def get_bookmarked(self,obj):
-        bookmark =  obj.sections_bookmarks.filter(user=self.context.get('user')).exists()
+        bookmarked = self.context.get('bookmarked_sections')
+        if bookmarked is not None:
+            return obj.id in bookmarked
+        bookmark =  obj.sections_bookmarks.filter(user=self.context.get('user'),is_bookmarked=True).exists()
         return bookmark
 
+class BookmarksSyncSerializer(serializers.Serializer):
+    section_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=True)
+
+    def validate_section_ids(self, value):
+        course = self.context.get('course')
+        section_ids = set(value)
+        existing = set(CourseSections.objects.filter(course=course, id__in=section_ids).values_list('id', flat=True))
+        if section_ids - existing:
+            raise serializers.ValidationError(f'Sections {sorted(section_ids - existing)} not found in this course')
+        return section_ids
+
+    def save(self, **kwargs):
+        course = self.context.get('course')
+        user = self.context.get('user')
+        section_ids = self.validated_data['section_ids']
+        with transaction.atomic():
+            SectionsBookmarks.objects.bulk_create(
+                [SectionsBookmarks(user=user, section_id=section_id, is_bookmarked=True) for section_id in section_ids],
+                update_conflicts=True, unique_fields=['user', 'section'], update_fields=['is_bookmarked'])
+            SectionsBookmarks.objects.filter(user=user, section__course=course, is_bookmarked=True) \
+                .exclude(section_id__in=section_ids).update(is_bookmarked=False)
+        return section_ids
+
+
 class SectionCreateUpdateSerializer(serializers.ModelSerializer):
     section_name = serializers.CharField(required=False)
     class Meta:
@@ -215,15 +370,15 @@ class SectionCreateUpdateSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         course = self.context['course']
-        order = CourseSections.objects.filter(course=course,).count() + 1
         section_name_ = validated_data.get('section_name')
         if not section_name_:
             section_name_ = 'Section1'
 
-        section = CourseSections.objects.create(
-            course=course,section_name=section_name_,order=order,)
+        with transaction.atomic():
+            section = CourseSections.objects.create(
+                course=course,section_name=section_name_,order=insert_rank(CourseSections, course.id),)
 
-        SectionContent.objects.create(section=section,order=1,title='block1',content='content1')
+            SectionContent.objects.create(section=section,order=ORDER_GAP,title='block1',content='content1')
         return section
 
     def update(self, instance,validated_data):
@@ -233,7 +388,8 @@ class SectionCreateUpdateSerializer(serializers.ModelSerializer):
 
 
 class SectionContentCreateUpdateSerializer(serializers.ModelSerializer):
-    order = serializers.IntegerField(required=False)
+    # position to insert the block at, appended when left out
+    order = serializers.IntegerField(required=False, min_value=1)
     content = serializers.CharField(required=False)
     content_type = serializers.CharField(required=True)
 
@@ -248,9 +404,9 @@ class SectionContentCreateUpdateSerializer(serializers.ModelSerializer):
         if not content_type in allowed_content_type:
             raise serializers.ValidationError('Invalid content type')
 
-        if not validated_data.get('order'):
-            validated_data['order'] = SectionContent.objects.filter(section=section).count() +1
+        position = validated_data.pop('order', None)
         with transaction.atomic():
+            validated_data['order'] = insert_rank(SectionContent, section.id, position)
             block = SectionContent.objects.create(section=section, **validated_data)
             if content_type == 'test':
                 TestBlock.objects.create(section=section,block=block)
@@ -277,12 +433,14 @@ class SectionTestCreateUpdateSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         section = self.context.get('section')
-        block_order = SectionContent.objects.filter(section=section).count() + 1
         with transaction.atomic():
+            order = insert_rank(SectionContent, section.id)
+            # appended, so its position is the count after the parent lock taken by insert_rank
+            block_order = siblings_of(SectionContent, section.id).count() + 1
             content = SectionContent.objects.create(section=section, content_type='test',
                                                 title=validated_data.get('title',f'Test{block_order}'),
                                                 content=validated_data.get('test_description',''),
-                                                order=block_order)
+                                                order=order)
 
             test = TestBlock.objects.create(section=content,test_title=validated_data.get('title',f'Test{block_order}'),
                                         test_description=validated_data.get('test_description',''))
@@ -291,10 +449,12 @@ class SectionTestCreateUpdateSerializer(serializers.ModelSerializer):
 
 
 class TestSerializer(serializers.ModelSerializer):
+    order = PositionField()
     test_answers = serializers.SerializerMethodField()
     class Meta:
         model = TestQuestions
         fields = ('id', 'order', 'test_question', 'test_answers')
+        list_serializer_class = PositionedListSerializer
 
     def get_test_answers(self, obj):
         from teacher_app.serializers import TestAnswerSerializer
@@ -303,6 +463,7 @@ class TestSerializer(serializers.ModelSerializer):
 
 
 class SectionWithTestSerializer(serializers.ModelSerializer):
+    order = PositionField()
     tests = SerializerMethodField()
     class Meta:
         model = SectionContent
@@ -353,6 +514,27 @@ class CourseRequestApprovalSerializer(serializers.Serializer):
 
 
 
+class RequestDecisionSerializer(serializers.Serializer):
+    request_id = serializers.IntegerField()
+    new_status = serializers.ChoiceField(choices=['approved', 'rejected'])
+
+
+class CourseRequestsBatchSerializer(serializers.Serializer):
+    decisions = RequestDecisionSerializer(many=True, allow_empty=False, max_length=1000)
+
+    def validate_decisions(self, value):
+        course = self.context.get('course')
+        request_ids = [decision['request_id'] for decision in value]
+        if len(set(request_ids)) != len(request_ids):
+            raise serializers.ValidationError('Each request can be moderated once per batch')
+        pending = set(CourseJoinRequests.objects.filter(course=course, id__in=request_ids, status='on_mod')
+                      .values_list('id', flat=True))
+        if set(request_ids) - pending:
+            raise serializers.ValidationError(f'Requests {sorted(set(request_ids) - pending)} '
+                                              f'are not pending in this course')
+        return value
+
+
 class CourseRequestSerializer(serializers.ModelSerializer):
     class Meta:
         model = CourseJoinRequests
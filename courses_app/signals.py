@@ -1,9 +1,14 @@
-from django.db import transaction
-from django.db.models.signals import post_save, pre_save
+from django.db import connections, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, post_migrate
 from django.dispatch import receiver
+from django.utils import timezone
 
-from courses_app.models import Course, CourseJoinRequests, CourseSections, SectionContent, CourseRoles
-from courses_app.utils import assign_role
+from courses_app.models import Course, CourseJoinRequests, CourseSections, SectionContent, CourseRoles, TestBlock, \
+    TestQuestions, TestAnswers
+from courses_app.leaderboard import refresh_course_score, refresh_test_score
+from courses_app.utils import assign_role, invalidate_course_roles
+from student_app.models import TestScore, TestSession
 
 
 
@@ -37,3 +42,67 @@ def add_user_to_course_or_reject(sender, instance, created, **kwargs):
         assign_role(instance.user, instance.course)
 
 
+@receiver(post_save, sender=CourseRoles)
+@receiver(post_delete, sender=CourseRoles)
+def drop_cached_course_role(sender, instance, **kwargs):
+    # after commit, or a concurrent request could read the old row and cache it again
+    course_id, user_id = instance.course_id, instance.user_id
+    transaction.on_commit(lambda: invalidate_course_roles(course_id, [user_id]))
+
+
+# path from Course to every model that is part of the course content tree
+CONTENT_VERSION_LOOKUPS = {
+    CourseSections: 'course_sections',
+    SectionContent: 'course_sections__section_content',
+    TestBlock: 'course_sections__section_content__tests',
+    TestQuestions: 'course_sections__section_content__tests__questions',
+    TestAnswers: 'course_sections__section_content__tests__questions__test_answers',
+}
+
+
+def bump_content_version(**course_filter):
+    Course.objects.filter(**course_filter).update(content_version=F('content_version') + 1,
+                                                  content_updated_at=timezone.now())
+
+
+def bump_content_version_for(sender, instance, **kwargs):
+    # pre_delete: the row still exists so the lookup can walk up to its course
+    bump_content_version(**{CONTENT_VERSION_LOOKUPS[sender]: instance.pk})
+
+
+@receiver(post_save, sender=Course)
+def bump_content_version_on_course_update(sender, instance, created, **kwargs):
+    # title/description/accessibility are part of the course content responses too
+    if not created:
+        bump_content_version(pk=instance.pk)
+
+
+# Only containers bump through signals. Questions and answers are written in bulk by a few paths
+# that bump once themselves (grading.record_question_change, ordering), so a test with N answers
+# doesn't update the course row N times and deletes keep cascading without fetching every leaf.
+for content_model in (CourseSections, SectionContent, TestBlock):
+    post_save.connect(bump_content_version_for, sender=content_model, dispatch_uid=f'content_version_save_{content_model.__name__}')
+    pre_delete.connect(bump_content_version_for, sender=content_model, dispatch_uid=f'content_version_delete_{content_model.__name__}')
+
+
+@receiver(post_delete, sender=TestScore)
+def drop_course_score_share(sender, instance, **kwargs):
+    # cascades (test or course deleted) fire this once per row, the refresh is idempotent
+    refresh_course_score(instance.course_id, instance.user_id)
+
+
+@receiver(post_delete, sender=TestSession)
+def drop_session_score(sender, instance, **kwargs):
+    if instance.is_finished:
+        refresh_test_score(instance.test_block_id, instance.user_id)
+
+
+@receiver(post_migrate)
+def backfill_test_totals(sender, using, **kwargs):
+    # TestBlock.max_score / question_count of tests made before the columns existed start at 0.
+    # TestBlock isn't in the migration history, so this runs after migrate instead of as a RunPython;
+    # only drifted rows are written, later runs are a single no-op UPDATE.
+    if sender.name != 'courses_app' or TestBlock._meta.db_table not in connections[using].introspection.table_names():
+        return
+    from courses_app.grading import recount_test_totals
+    recount_test_totals(TestBlock.objects.using(using).all())
@@ -0,0 +1,30 @@
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+STREAM_CHUNK_SIZE = 2000
+
+
+def iter_chunks(queryset, chunk_size=STREAM_CHUNK_SIZE):
+    # server-side cursor on postgres; prefetch_related runs once per chunk
+    chunk = []
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def json_array_stream(queryset, serialize_chunk, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields a JSON array piece by piece, only one chunk of rows is kept in memory"""
+    yield '['
+    separator = ''
+    for chunk in iter_chunks(queryset, chunk_size):
+        items = serialize_chunk(chunk)
+        if not items:
+            continue
+        yield separator + ','.join(json.dumps(item, cls=JSONEncoder) for item in items)
+        separator = ','
+    yield ']'
@@ -1,6 +1,24 @@
 # Create your tests here.
+import csv
+import io
+import json
+from datetime import timedelta
+
 from conftest import *
-from courses_app.models import Course, CourseJoinRequests, CourseRoles
+from django.http import Http404
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from Learning_platform import tasks
+
+from courses_app.models import Course, CourseJoinRequests, CourseRoles, CourseSections, SectionsBookmarks, \
+    SectionContent, TestBlock
+from courses_app.ordering import ORDER_GAP, ReorderSerializer, apply_order, with_positions
+from courses_app.serializers import CourseSectionsGetSerializer, SectionTestCreateUpdateSerializer
+from courses_app.utils import get_course_role, resolve_course_path
+from main.permissions import Student, CoLecturerOrAbove
+from student_app.models import TestSession
 
 
 #client
@@ -66,4 +84,358 @@ def test_course_request_staff(private_course,staff_with_auth,user_staff):
     print('CourseJoinRequests:', [(r.id, r.course.id, r.user.id) for r in CourseJoinRequests.objects.all()])
     print('Test course:', private_course.id)
     print('Test user:', user_staff.id)
-    assert CourseJoinRequests.objects.filter(course=private_course,user=user_staff,status='approved').exists()
\ No newline at end of file
+    assert CourseJoinRequests.objects.filter(course=private_course,user=user_staff,status='approved').exists()
+
+@pytest.mark.django_db
+def test_course_catalog_keyset_pages(student_with_auth, user_teacher_approved):
+    for i in range(5):
+        course = Course.objects.create(owner=user_teacher_approved, title=f'course {i}', short_description='catalog')
+        CourseRoles.objects.create(course=course, user=user_teacher_approved, course_role='lecturer')
+
+    seen = []
+    cursor = None
+    while True:
+        params = {'catalog': 'true', 'page_size': 2}
+        if cursor:
+            params['cursor'] = cursor
+        response = student_with_auth.get('/courses/', params)
+        assert response.status_code == 200
+        seen += [c['id'] for c in response.json()['results']]
+        assert all(c['members_count'] == 1 for c in response.json()['results'])
+        cursor = response.json()['next']
+        if not cursor:
+            break
+
+    assert seen == list(Course.objects.order_by('created_at', 'id').values_list('id', flat=True))
+
+
+@pytest.mark.django_db
+def test_course_outline_cache_follows_content_version(student_with_auth, user_student, user_teacher_approved):
+    course = Course.objects.create(owner=user_teacher_approved, title='cached', short_description='cached')
+    section = CourseSections.objects.create(course=course, section_name='first', order=1)
+    SectionsBookmarks.objects.create(user=user_student, section=section, is_bookmarked=True)
+
+    first = student_with_auth.get(f'/courses/{course.id}/').json()
+    assert [s['section_name'] for s in first['course_sections']] == ['first']
+    assert first['course_sections'][0]['bookmarked'] is True
+
+    version = Course.objects.get(pk=course.pk).content_version
+    CourseSections.objects.create(course=course, section_name='second', order=2)
+    assert Course.objects.get(pk=course.pk).content_version == version + 1
+
+    second = student_with_auth.get(f'/courses/{course.id}/').json()
+    assert [s['section_name'] for s in second['course_sections']] == ['first', 'second']
+    assert [s['bookmarked'] for s in second['course_sections']] == [True, False]
+
+
+@pytest.mark.django_db
+def test_bookmarks_sync_replaces_set(student_with_auth, user_student, user_teacher_approved):
+    course = Course.objects.create(owner=user_teacher_approved, title='bookmarks', short_description='bookmarks')
+    CourseRoles.objects.create(course=course, user=user_student, course_role='student')
+    sections = [CourseSections.objects.create(course=course, section_name=f's{i}', order=i) for i in range(1, 4)]
+    SectionsBookmarks.objects.create(user=user_student, section=sections[0], is_bookmarked=True)
+
+    response = student_with_auth.put(f'/courses/{course.id}/bookmarks/',
+                                     {'section_ids': [sections[1].id, sections[2].id]}, format='json')
+    assert response.status_code == 200
+    assert set(SectionsBookmarks.objects.filter(user=user_student, is_bookmarked=True)
+               .values_list('section_id', flat=True)) == {sections[1].id, sections[2].id}
+
+    listing = student_with_auth.get(f'/courses/{course.id}/sections/').json()
+    assert [s['bookmarked'] for s in listing] == [False, True, True]
+
+
+@pytest.mark.django_db
+def test_course_role_resolved_once_and_invalidated(user_student, user_teacher_approved, django_assert_num_queries,
+                                                   django_capture_on_commit_callbacks, settings):
+    settings.SHARED_CACHE = True
+    course = Course.objects.create(owner=user_teacher_approved, title='roles', short_description='roles')
+    role = CourseRoles.objects.create(course=course, user=user_student, course_role='student')
+
+    def make_request():
+        request = Request(APIRequestFactory().get('/'))
+        request.user = user_student
+        return request
+
+    request = make_request()
+    with django_assert_num_queries(1):
+        assert Student().has_object_permission(request, None, course)
+        assert not CoLecturerOrAbove().has_object_permission(request, None, course)
+    with django_assert_num_queries(0):
+        assert get_course_role(make_request(), course) == 'student'
+
+    role.course_role = 'co_lecturer'
+    with django_capture_on_commit_callbacks(execute=True):
+        role.save()
+    assert CoLecturerOrAbove().has_object_permission(make_request(), None, course)
+
+
+@pytest.mark.django_db
+def test_nested_route_resolved_in_one_query(user_student, user_teacher_approved, django_assert_num_queries):
+    course = Course.objects.create(owner=user_teacher_approved, title='nested', short_description='nested')
+    CourseRoles.objects.create(course=course, user=user_student, course_role='student')
+    section = CourseSections.objects.create(course=course, section_name='s1', order=1)
+    block = SectionContent.objects.create(section=section, order=1, title='b1', content='b1', content_type='test')
+    test = TestBlock.objects.create(section=block, test_title='t1', test_description='t1')
+    request = Request(APIRequestFactory().get('/'))
+    request.user = user_student
+
+    with django_assert_num_queries(1):
+        path = resolve_course_path(request, course.id, section.id, block.id, test=True)
+        assert (path.course, path.section, path.block, path.test) == (course, section, block, test)
+        assert Student().has_object_permission(request, None, path.course)
+        assert not CoLecturerOrAbove().has_object_permission(request, None, path.course)
+
+    with pytest.raises(Http404):
+        resolve_course_path(request, course.id + 1, section.id, block.id)
+    with pytest.raises(Http404):
+        resolve_course_path(request, 'abc', section.id, block.id)
+
+
+@pytest.mark.django_db
+def test_search_respects_course_accessibility(student_with_auth, user_student, user_teacher_approved):
+    public = Course.objects.create(owner=user_teacher_approved, title='Linear algebra', short_description='matrices')
+    hidden = Course.objects.create(owner=user_teacher_approved, title='Algebra secrets', short_description='matrices',
+                                   course_accessibility='on_invite_only')
+    joined = Course.objects.create(owner=user_teacher_approved, title='Calculus', short_description='limits',
+                                   course_accessibility='on_requests')
+    CourseRoles.objects.create(course=joined, user=user_student, course_role='student')
+    section = CourseSections.objects.create(course=joined, section_name='s1', order=1)
+    SectionContent.objects.create(section=section, order=1, title='Matrices intro', content='Gaussian elimination')
+    hidden_section = CourseSections.objects.create(course=hidden, section_name='s1', order=1)
+    SectionContent.objects.create(section=hidden_section, order=1, title='Matrices', content='Gaussian elimination')
+
+    response = student_with_auth.get('/courses/search/', {'q': 'algebra'})
+    assert response.status_code == 200
+    assert [c['id'] for c in response.json()['courses']] == [public.id]
+
+    blocks = student_with_auth.get('/courses/search/', {'q': 'gaussian'}).json()['blocks']
+    assert [b['course_id'] for b in blocks] == [joined.id]
+
+    suggestions = student_with_auth.get('/courses/search/', {'q': 'alg', 'autocomplete': 'true'}).json()
+    assert [c['id'] for c in suggestions['courses']] == [public.id]
+
+
+@pytest.mark.django_db
+def test_outline_mode_omits_block_bodies(student_with_auth, user_student, user_teacher_approved):
+    course = Course.objects.create(owner=user_teacher_approved, title='outline', short_description='outline')
+    CourseRoles.objects.create(course=course, user=user_student, course_role='student')
+    section = CourseSections.objects.create(course=course, section_name='s1', order=1)
+    SectionContent.objects.create(section=section, order=1, title='b1', content='long lecture text')
+
+    course_outline = student_with_auth.get(f'/courses/{course.id}/', {'outline': 'true'}).json()
+    assert course_outline['course_sections'][0]['section_content'] == [
+        {'id': section.section_content.get().id, 'order': 1, 'content_type': 'lection', 'title': 'b1'}]
+
+    sections = student_with_auth.get(f'/courses/{course.id}/sections/', {'outline': 'true'}).json()
+    assert 'content' not in sections[0]['section_content'][0]
+    assert 'test_block' not in sections[0]['section_content'][0]
+
+    full = student_with_auth.get(f'/courses/{course.id}/').json()
+    assert full['course_sections'][0]['section_content'][0]['content'] == 'long lecture text'
+
+
+@pytest.mark.django_db
+def test_course_etag_revalidation(student_with_auth, user_student, user_teacher_approved, django_assert_num_queries):
+    course = Course.objects.create(owner=user_teacher_approved, title='etag', short_description='etag')
+    CourseRoles.objects.create(course=course, user=user_student, course_role='student')
+    section = CourseSections.objects.create(course=course, section_name='s1', order=1)
+
+    response = student_with_auth.get(f'/courses/{course.id}/')
+    etag = response['ETag']
+    assert response.status_code == 200 and etag
+
+    # user lookup for JWT auth + course row + bookmark state
+    with django_assert_num_queries(3):
+        response = student_with_auth.get(f'/courses/{course.id}/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+
+    student_with_auth.post(f'/courses/{course.id}/bookmark/', {'section_id': section.id})
+    response = student_with_auth.get(f'/courses/{course.id}/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()['course_sections'][0]['bookmarked'] is True
+
+    etag = response['ETag']
+    course.title = 'renamed'
+    course.save()
+    response = student_with_auth.get(f'/courses/{course.id}/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response.json()['title'] == 'renamed'
+
+
+@pytest.mark.django_db
+def test_bulk_enroll_reports_outcomes(teacher_with_auth, user_teacher_approved, user_student):
+    course = Course.objects.create(owner=user_teacher_approved, title='cohort', short_description='cohort')
+    CourseRoles.objects.create(course=course, user=user_teacher_approved, course_role='lecturer')
+    cohort = SiteUser.objects.bulk_create([SiteUser(username=f'cohort{i}', role='student') for i in range(3)])
+
+    request = Request(APIRequestFactory().get('/'))
+    request.user = user_student
+    assert get_course_role(request, course) is None
+
+    payload = {'users': [{'user_id': user_student.id},
+                         *[{'user_id': user.id, 'role': 'student'} for user in cohort],
+                         {'user_id': user_teacher_approved.id},
+                         {'user_id': user_student.id},
+                         {'user_id': 999999}]}
+    response = teacher_with_auth.post(f'/courses/{course.id}/users/bulk/', payload, format='json')
+    assert response.status_code == 200
+    statuses = [(r['user_id'], r['status']) for r in response.data['results']]
+    assert (user_student.id, 'enrolled') in statuses
+    assert (user_student.id, 'duplicate') in statuses
+    assert (user_teacher_approved.id, 'already_enrolled') in statuses
+    assert (999999, 'not_found') in statuses
+    assert course.users.count() == 4
+    assert CourseRoles.objects.filter(course=course, course_role='student').count() == 4
+
+    request = Request(APIRequestFactory().get('/'))
+    request.user = user_student
+    assert get_course_role(request, course) == 'student'
+
+    response = teacher_with_auth.post(f'/courses/{course.id}/users/bulk/',
+                                      {'users': [{'user_id': cohort[0].id, 'role': 'lecturer'}]}, format='json')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_join_requests_moderated_in_one_batch(teacher_with_auth, user_teacher_approved, monkeypatch):
+    course = Course.objects.create(owner=user_teacher_approved, title='queue', short_description='queue',
+                                   course_accessibility='private')
+    CourseRoles.objects.create(course=course, user=user_teacher_approved, course_role='lecturer')
+    applicants = SiteUser.objects.bulk_create([SiteUser(username=f'applicant{i}', role='student') for i in range(4)])
+    requests = CourseJoinRequests.objects.bulk_create([CourseJoinRequests(course=course, user=user)
+                                                       for user in applicants])
+    decisions = [{'request_id': r.id, 'new_status': 'approved' if i % 2 == 0 else 'rejected'}
+                 for i, r in enumerate(requests)]
+
+    dispatched = []
+    monkeypatch.setattr(tasks.moderate_join_requests, 'delay', lambda *args: dispatched.append(args))
+    response = teacher_with_auth.post(f'/courses/{course.id}/requests/batch/', {'decisions': decisions},
+                                      format='json')
+    assert response.status_code == 202
+    assert len(dispatched) == 1
+
+    assert tasks.moderate_join_requests(*dispatched[0]) == 'Approved 2, rejected 2, skipped 0'
+    assert set(course.users.values_list('id', flat=True)) == {applicants[0].id, applicants[2].id}
+    assert CourseRoles.objects.filter(course=course, course_role='student').count() == 2
+    assert tasks.moderate_join_requests(*dispatched[0]) == 'Approved 0, rejected 0, skipped 4'
+
+    response = teacher_with_auth.post(f'/courses/{course.id}/requests/batch/', {'decisions': decisions[:1]},
+                                      format='json')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_gradebook_exports(teacher_with_auth, exam, user_student, settings, tmp_path, monkeypatch):
+    other = SiteUser.objects.create_user(username='quiet', password='1234')
+    CourseRoles.objects.create(course_id=exam.section.section.course_id, user=other, course_role='student')
+    for score, minutes in ((1, 30), (3, 20), (2, 10)):
+        TestSession.objects.create(test_block=exam, user=user_student, is_finished=True, summary_score=score,
+                                   finished_at=timezone.now() - timedelta(minutes=minutes))
+    url = f'/courses/{exam.section.section.course_id}/gradebook/'
+
+    response = teacher_with_auth.get(url)
+    assert response.status_code == 200 and response.streaming
+    rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+    assert rows[0] == ['user_id', 'username', f'exam #{exam.id} best', f'exam #{exam.id} latest']
+    assert rows[1:] == [[str(user_student.id), 'student', '3.0', '2.0'], [str(other.id), 'quiet', '', '']]
+
+    response = teacher_with_auth.get(url + '?export=ndjson')
+    lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+    assert lines[0]['tests'] == {str(exam.id): {'best': 3.0, 'latest': 2.0}}
+
+    settings.GRADEBOOK_EXPORT_DIR = tmp_path
+    monkeypatch.setattr(tasks.export_gradebook, 'delay', tasks.export_gradebook)
+    response = teacher_with_auth.get(url + '?background=true')
+    assert response.status_code == 202
+    file_name = response.data['file']
+    response = teacher_with_auth.get(url + f'?file={file_name}')
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content).decode().splitlines()[1].endswith('3.0,2.0')
+    assert teacher_with_auth.get(url + '?file=../settings.py').status_code == 404
+    (tmp_path / f'{file_name}.part').write_text('half written')
+    assert teacher_with_auth.get(url + f'?file={file_name}.part').status_code == 404
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reorder_sections_in_one_statement(teacher_with_auth, exam):
+    course = exam.section.section.course
+    first = exam.section.section
+    second, third = [CourseSections.objects.create(course=course, section_name=name, order=order)
+                     for order, name in ((2, 'second'), (3, 'third'))]
+    url = f'/courses/{course.id}/sections/reorder/'
+
+    response = teacher_with_auth.post(url, {'order': [third.id, first.id, second.id]}, format='json')
+    assert response.status_code == 200
+    assert [section['id'] for section in response.data] == [third.id, first.id, second.id]
+    assert [section['order'] for section in response.data] == [1, 2, 3]
+
+    response = teacher_with_auth.post(url, {'move': third.id, 'before': None}, format='json')
+    assert [section['id'] for section in response.data] == [first.id, second.id, third.id]
+
+    response = teacher_with_auth.post(f'/courses/{course.id}/sections/swap/',
+                                      {'from_section': 1, 'to_section': 3}, format='json')
+    assert response.status_code == 200
+    assert list(course.course_sections.values_list('id', flat=True)) == [third.id, second.id, first.id]
+
+    assert teacher_with_auth.post(url, {'order': [first.id, second.id]}, format='json').status_code == 400
+
+
+@pytest.mark.django_db
+def test_new_test_block_titled_by_position(exam):
+    serializer = SectionTestCreateUpdateSerializer(data={'test_title': 'ignored', 'test_description': 'second'},
+                                                   context={'section': exam.section.section})
+    serializer.is_valid(raise_exception=True)
+    test = serializer.save()
+    assert (test.test_title, test.section.title) == ('Test2', 'Test2')
+
+
+@pytest.mark.django_db
+def test_reorder_questions_and_answers(teacher_with_auth, exam, user_student):
+    single, multiple, double = exam.questions.all()
+    url = f'/courses/{exam.section.section.course_id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/'
+
+    response = teacher_with_auth.post(url + 'reorder/', {'move': double.id, 'before': single.id}, format='json')
+    assert response.status_code == 200
+    assert [question['id'] for question in response.data] == [double.id, single.id, multiple.id]
+
+    # ranks are read again under the parent lock, a move validated before a concurrent reorder still lands right
+    reorder = ReorderSerializer(data={'move': multiple.id, 'before': single.id},
+                                context={'siblings': exam.questions.all()})
+    reorder.is_valid(raise_exception=True)
+    apply_order(exam.questions.all(), [single.id, double.id, multiple.id])
+    assert [question.id for question in reorder.save()] == [multiple.id, single.id, double.id]
+
+    answers = list(multiple.test_answers.values_list('id', flat=True))
+    response = teacher_with_auth.post(f'{url}{multiple.id}/answers/reorder/', {'order': answers[::-1]},
+                                      format='json')
+    assert response.status_code == 200
+    assert [answer['id'] for answer in response.data] == answers[::-1]
+
+    student = APIClient()
+    student.force_authenticate(user_student)
+    assert student.post(url + 'reorder/', {'move': double.id}, format='json').status_code == 403
+
+
+@pytest.mark.django_db
+def test_gap_ranks_keep_dense_positions(teacher_with_auth, exam, monkeypatch, django_capture_on_commit_callbacks):
+    section = exam.section.section
+    url = f'/courses/{section.course_id}/sections/{section.id}/blocks/'
+    lection = {'content_type': 'lection', 'content': 'text'}
+    assert teacher_with_auth.post(url, {**lection, 'title': 'last'}, format='json').status_code == 201
+    # rank 1 leaves no room in front, the siblings are respaced once and the new block goes halfway
+    assert teacher_with_auth.post(url, {**lection, 'title': 'first', 'order': 1}, format='json').status_code == 201
+    assert list(section.section_content.values_list('title', 'order')) == \
+        [('first', ORDER_GAP // 2), ('exam', ORDER_GAP), ('last', 2 * ORDER_GAP)]
+
+    data = CourseSectionsGetSerializer(with_positions(CourseSections.objects.filter(pk=section.pk)), many=True).data
+    assert [(block['title'], block['order']) for block in data[0]['section_content']] == \
+        [('first', 1), ('exam', 2), ('last', 3)]
+
+    # taking the last free rank between two neighbours respaces them in the background
+    SectionContent.objects.filter(section=section, title='first').update(order=ORDER_GAP - 2)
+    monkeypatch.setattr(tasks.rebalance_order_keys, 'delay', tasks.rebalance_order_keys)
+    with django_capture_on_commit_callbacks(execute=True):
+        response = teacher_with_auth.post(url, {**lection, 'title': 'second', 'order': 2}, format='json')
+    assert response.status_code == 201
+    assert list(section.section_content.values_list('title', 'order')) == \
+        [('first', ORDER_GAP), ('second', 2 * ORDER_GAP), ('exam', 3 * ORDER_GAP), ('last', 4 * ORDER_GAP)]
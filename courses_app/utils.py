@@ -1,7 +1,14 @@
-from courses_app.models import CourseRoles
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Subquery
+from django.http import Http404
+from rest_framework.generics import get_object_or_404
 
-from student_app.models import TestUserAnswers
+from courses_app.models import CourseRoles, SectionsBookmarks, Course, CourseSections, SectionContent, TestBlock, \
+    TestQuestions
+from rest_framework.exceptions import PermissionDenied, ValidationError
 
 
 def assign_role(user,course,role=None):
@@ -10,6 +17,114 @@ def assign_role(user,course,role=None):
         CourseRoles.objects.create(user=user,course=course,course_role=new_role)
 
 
+COURSE_ROLE_CACHE_TIMEOUT = 60 * 10
+# misses are kept briefly only, a join right after a denied request shouldn't wait for them
+NO_COURSE_ROLE_CACHE_TIMEOUT = 5
+NO_COURSE_ROLE = ''
+
+
+def shared_cache_enabled():
+    return getattr(settings, 'SHARED_CACHE', False)
+
+
+def course_role_cache_key(course_id, user_id):
+    return f'course-role:{course_id}:{user_id}'
+
+
+def invalidate_course_roles(course_id, user_ids):
+    cache.delete_many([course_role_cache_key(course_id, user_id) for user_id in user_ids])
+
+
+def remember_course_role(request, course_id, role):
+    roles = getattr(request, '_course_roles', None)
+    if roles is None:
+        roles = request._course_roles = {}
+    roles[int(course_id)] = role or NO_COURSE_ROLE
+
+
+def get_course_role(request, course):
+    """
+    CourseRoles.course_role of request.user in course or None.
+    Resolved once per request. With a shared cache it is also shared between requests,
+    the entry is dropped after every committed CourseRoles change.
+    """
+    course_id = int(getattr(course, 'pk', course))
+    roles = getattr(request, '_course_roles', None) or {}
+    if course_id in roles:
+        return roles[course_id] or None
+
+    role = None
+    key = course_role_cache_key(course_id, request.user.id)
+    if shared_cache_enabled():
+        role = cache.get(key)
+    if role is None:
+        role = CourseRoles.objects.filter(course_id=course_id, user=request.user) \
+            .values_list('course_role', flat=True).first() or NO_COURSE_ROLE
+        if shared_cache_enabled():
+            cache.set(key, role, COURSE_ROLE_CACHE_TIMEOUT if role else NO_COURSE_ROLE_CACHE_TIMEOUT)
+    remember_course_role(request, course_id, role)
+    return role or None
+
+
+CoursePath = namedtuple('CoursePath', ['course', 'section', 'block', 'test', 'question'])
+
+
+def resolve_course_path(request, course_pk, section_pk=None, block_pk=None, test=False, question_pk=None):
+    """
+    Checks the nested route course -> section -> block -> test -> question in one joined query
+    and remembers the caller's course role on the request, so permission checks don't query again.
+    """
+    try:
+        course_pk, section_pk, block_pk, question_pk = (
+            None if pk is None else int(pk) for pk in (course_pk, section_pk, block_pk, question_pk))
+    except (TypeError, ValueError):
+        # the role subquery is built before any lookup, a malformed id must not reach it
+        raise Http404('Not found')
+
+    role = Subquery(CourseRoles.objects.filter(course_id=course_pk, user_id=request.user.id)
+                    .values('course_role')[:1])
+
+    if question_pk is not None:
+        obj = get_object_or_404(
+            TestQuestions.objects.select_related('test_block__section__section__course')
+            .defer('test_block__section__search_vector').annotate(caller_role=role),
+            pk=question_pk, test_block__section_id=block_pk, test_block__section__section_id=section_pk,
+            test_block__section__section__course_id=course_pk)
+        path = CoursePath(obj.test_block.section.section.course, obj.test_block.section.section,
+                          obj.test_block.section, obj.test_block, obj)
+    elif test:
+        obj = get_object_or_404(
+            TestBlock.objects.select_related('section__section__course').defer('section__search_vector')
+            .annotate(caller_role=role),
+            section_id=block_pk, section__section_id=section_pk, section__section__course_id=course_pk)
+        path = CoursePath(obj.section.section.course, obj.section.section, obj.section, obj, None)
+    elif block_pk is not None:
+        obj = get_object_or_404(
+            SectionContent.objects.select_related('section__course').defer('search_vector')
+            .annotate(caller_role=role),
+            pk=block_pk, section_id=section_pk, section__course_id=course_pk)
+        path = CoursePath(obj.section.course, obj.section, obj, None, None)
+    elif section_pk is not None:
+        obj = get_object_or_404(CourseSections.objects.select_related('course').annotate(caller_role=role),
+                                pk=section_pk, course_id=course_pk)
+        path = CoursePath(obj.course, obj, None, None, None)
+    else:
+        obj = get_object_or_404(Course.objects.annotate(caller_role=role), pk=course_pk)
+        path = CoursePath(obj, None, None, None, None)
+
+    remember_course_role(request, path.course.pk, obj.caller_role)
+    return path
+
+
+def get_bookmarked_sections(user, course):
+    return set(SectionsBookmarks.objects.filter(user=user, section__course=course, is_bookmarked=True)
+               .values_list('section_id', flat=True))
+
+
+def query_flag(request, name):
+    return request.query_params.get(name, '').lower() in ('1', 'true', 'yes')
+
+
 def check_object_permissions(view, request, obj):
     for permission in view.get_permissions():
         if hasattr(permission, 'has_object_permission'):
@@ -29,24 +144,3 @@ def validate_answers(answers, answers_type):
         raise ValidationError('Test answer type is single but u marked as correct several answers')
 
     return answers
-
-def check_test_results(questions, session):
-    score = 0
-    for question in questions:
-        try:
-            user_answer = TestUserAnswers.objects.get(question=question, session=session)
-        except TestUserAnswers.DoesNotExist:
-            continue
-
-        correct_answers = set(question.test_answers.filter(is_correct=True).values_list("id", flat=True))
-        user_answers = set(user_answer.selected_answers.values_list("id", flat=True))
-
-        if correct_answers == user_answers:
-            points = 0
-            points += question.max_points or 0
-            score += points
-            user_answer.score = question.max_points
-        else:
-            user_answer.score = 0
-        user_answer.save()
-    return score
\ No newline at end of file
@@ -1,5 +1,6 @@
 from django.db import transaction
-from django.db.models import Prefetch
+from django.http import StreamingHttpResponse, FileResponse, Http404
+from django.db.models import Prefetch, Count
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 from rest_framework import viewsets, status
 from rest_framework.authentication import SessionAuthentication
@@ -11,17 +12,30 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.decorators import action
 
-from Learning_platform.tasks import change_request_status_and_add
-from courses_app.utils import assign_role, check_object_permissions
+from Learning_platform.tasks import change_request_status_and_add, moderate_join_requests, export_gradebook
+from courses_app.cache import OUTLINE_BLOCK_FIELDS
+from courses_app.conditional import course_content_validators, not_modified_response, set_validators
+from courses_app.gradebook import GRADEBOOK_FORMATS, gradebook_lines, gradebook_export_dir, gradebook_file_name, \
+    is_gradebook_file
+from courses_app.leaderboard import leaderboard, leaderboard_size
+from courses_app.ordering import ReorderSerializer, sibling_at, swap_ranks, with_positions
+from courses_app.pagination import KeysetPagination
+from courses_app.search import search_courses, search_blocks, autocomplete
+from courses_app.utils import assign_role, check_object_permissions, get_bookmarked_sections, resolve_course_path, \
+    query_flag
 from courses_app.models import Course, SectionsBookmarks, CourseSections, CourseJoinRequests, SectionContent, TestBlock, \
     CourseRoles
 from courses_app.serializers import CourseSerializer, CourseSettingsSerializer, CourseSectionsSerializer, \
     CourseRequestSerializer, RequestsToCourseSerializer, CourseSectionsGetSerializer, SectionCreateUpdateSerializer, \
     SectionContentSerializer, SectionContentCreateUpdateSerializer, CourseRequestApprovalSerializer, \
     CourseDataGetSerializer, UserCourseInfoSerializer, CourseUserPromoteSerializer, CourseUserKickSerializer, \
-    SectionTestCreateUpdateSerializer, SectionContentMultiSerializer, AdminSectionContentMultiSerializer
+    SectionTestCreateUpdateSerializer, SectionContentMultiSerializer, AdminSectionContentMultiSerializer, \
+    CourseCatalogSerializer, CourseDataCachedSerializer, BookmarksSyncSerializer, CourseSearchResultSerializer, \
+    SectionContentSearchResultSerializer, CourseSectionsOutlineSerializer, CourseBulkEnrollSerializer, \
+    CourseRequestsBatchSerializer
 from main.models import SiteUser
 from main.permissions import *
+from student_app.models import CourseScore
 from student_app.serializers import StudentCourseLeaveSerializer, CodeJoinCourseSerializer
 from teacher_app.serializers import RawTestSerializer, TestBlockGetUpdateSerializer
 
@@ -32,24 +46,87 @@ class CourseViewSet(viewsets.ViewSet):
     permission_classes = (IsAuthenticated,)
 
     @extend_schema(summary='course list',
-                   responses={200: CourseSerializer, 400: OpenApiResponse(description='error message')}, )
+                   responses={200: CourseSerializer, 400: OpenApiResponse(description='error message')},
+                   parameters=[
+                       OpenApiParameter(name='catalog', location=OpenApiParameter.QUERY, required=False, type=bool,
+                                        description='Paginated catalog with member counts instead of user lists'),
+                       OpenApiParameter(name='cursor', location=OpenApiParameter.QUERY, required=False, type=str),
+                       OpenApiParameter(name='page_size', location=OpenApiParameter.QUERY, required=False, type=int),
+                       OpenApiParameter(name='course_accessibility', location=OpenApiParameter.QUERY,
+                                        required=False, type=str),
+                       OpenApiParameter(name='owner', location=OpenApiParameter.QUERY, required=False, type=int),
+                   ])
     def list(self, request):
-        queryset = Course.objects.select_related('owner').prefetch_related('users')
+        queryset = Course.objects.all()
+        accessibility = request.query_params.get('course_accessibility')
+        owner = request.query_params.get('owner')
+        if accessibility:
+            queryset = queryset.filter(course_accessibility=accessibility.strip().lower())
+        if owner:
+            if not owner.isdigit():
+                raise ValidationError({'owner': 'Must be an integer'})
+            queryset = queryset.filter(owner_id=int(owner))
+
+        if query_flag(request, 'catalog'):
+            paginator = KeysetPagination(keyset_fields=('created_at', 'id'))
+            page = paginator.paginate_queryset(queryset.annotate(members_count=Count('course_roles')), request)
+            serializer = CourseCatalogSerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
+
+        queryset = queryset.prefetch_related(
+            Prefetch('course_roles', queryset=CourseRoles.objects.select_related('user')))
         serializer = CourseSerializer(queryset, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+    @extend_schema(summary='search courses and lectures',
+                   responses={200: OpenApiResponse(description='Ranked courses and blocks / autocomplete titles'),
+                              400: OpenApiResponse(description='Query too short')},
+                   parameters=[
+                       OpenApiParameter(name='q', location=OpenApiParameter.QUERY, required=True, type=str),
+                       OpenApiParameter(name='autocomplete', location=OpenApiParameter.QUERY, required=False,
+                                        type=bool, description='Title prefix matching instead of full-text'),
+                       OpenApiParameter(name='limit', location=OpenApiParameter.QUERY, required=False, type=int),
+                   ])
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        text = request.query_params.get('q', '').strip()
+        if len(text) < 2:
+            raise ValidationError({'q': 'At least 2 characters required'})
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 50)
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer'})
+        user = request.user
+
+        if query_flag(request, 'autocomplete'):
+            return Response(autocomplete(user, text, limit), status=status.HTTP_200_OK)
+
+        return Response({
+            'courses': CourseSearchResultSerializer(search_courses(user, text, limit), many=True).data,
+            'blocks': SectionContentSearchResultSerializer(search_blocks(user, text, limit), many=True).data,
+        }, status=status.HTTP_200_OK)
+
+
     @extend_schema(summary='course detail',
                    responses={200: CourseSerializer, 400: OpenApiResponse(description='error message'),
                               404: OpenApiResponse(description='Course not found')},
                    parameters=[
-                       OpenApiParameter(name='course_id', location=OpenApiParameter.PATH, description='Course ID'), ]
+                       OpenApiParameter(name='course_id', location=OpenApiParameter.PATH, description='Course ID'),
+                       OpenApiParameter(name='outline', location=OpenApiParameter.QUERY, required=False, type=bool,
+                                        description='Only ids, titles and order of blocks'), ]
                    )
     def retrieve(self, request, pk=None):
         user = request.user
-        course = get_object_or_404(Course.objects.select_related('owner').prefetch_related('users'), pk=pk)
-        serializer = CourseDataGetSerializer(course, context={'user': user})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        course = get_object_or_404(Course, pk=pk)
+        outline_only = query_flag(request, 'outline')
+        etag, last_modified = course_content_validators(course, user, 'course', outline_only)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        serializer = CourseDataCachedSerializer(course, context={'user': user, 'outline_only': outline_only})
+        return set_validators(Response(serializer.data, status=status.HTTP_200_OK), etag, last_modified)
 
 
     @extend_schema(summary='course leave',
@@ -118,9 +195,6 @@ class CourseViewSet(viewsets.ViewSet):
         course = get_object_or_404(Course, pk=pk)
         check_object_permissions(self, request, course)
         if request.method == "PATCH":
-
-            check_object_permissions(self, request, course)
-
             serializer = CourseSettingsSerializer(course, data=request.data, partial=True)
             if serializer.is_valid(raise_exception=True):
                 serializer.save()
@@ -152,6 +226,22 @@ class CourseViewSet(viewsets.ViewSet):
         return Response({'message': f'Bookmark {'added' if bookmark.is_bookmarked else 'removed'}',
                          'is_bookmarked': f'{bookmark.is_bookmarked}'}, status=status.HTTP_202_ACCEPTED)
 
+    @extend_schema(summary='sync section bookmarks',
+                   request=BookmarksSyncSerializer,
+                   responses={200: OpenApiResponse(description='Bookmarked sections ids after sync'),
+                              400: OpenApiResponse(description='Sections not found in course'),
+                              404: OpenApiResponse(description='Course not found')},
+                   parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, description='Course ID'), ],
+                   )
+    @action(detail=True, methods=['put'], url_path='bookmarks', permission_classes=[IsAuthenticated, Student])
+    def sync_bookmarks(self, request, pk=None):
+        course = get_object_or_404(Course, pk=pk)
+        check_object_permissions(self, request, course)
+        serializer = BookmarksSyncSerializer(data=request.data, context={'course': course, 'user': request.user})
+        serializer.is_valid(raise_exception=True)
+        section_ids = serializer.save()
+        return Response({'bookmarked': sorted(section_ids)}, status=status.HTTP_200_OK)
+
     @extend_schema(summary='get course users',
                    request=CourseUserPromoteSerializer,
                    responses={'200': UserCourseInfoSerializer},
@@ -180,6 +270,76 @@ class CourseViewSet(viewsets.ViewSet):
             output_serializer = UserCourseInfoSerializer(user, context={'course': course})
             return Response(output_serializer.data, status=status.HTTP_200_OK)
 
+    @extend_schema(summary='bulk enroll users',
+                   request=CourseBulkEnrollSerializer,
+                   responses={200: OpenApiResponse(description='Outcome per user'),
+                              400: OpenApiResponse(description='error message'),
+                              404: OpenApiResponse(description='Course not found')},
+                   parameters=[
+                       OpenApiParameter(name='pk', location=OpenApiParameter.PATH, description='Course ID'), ], )
+    @action(detail=True, methods=['post'], url_path='users/bulk', permission_classes=[IsAuthenticated, LecturerOrAbove])
+    def bulk_enroll(self, request, pk):
+        course = get_object_or_404(Course, pk=pk)
+        check_object_permissions(self, request, course)
+        serializer = CourseBulkEnrollSerializer(data=request.data, context={'course': course})
+        serializer.is_valid(raise_exception=True)
+        return Response({'results': serializer.save()}, status=status.HTTP_200_OK)
+
+    @extend_schema(summary='course gradebook export',
+                   responses={200: OpenApiResponse(description='Students x tests best/latest scores as a stream or file'),
+                              202: OpenApiResponse(description='Background export started, poll with ?file='),
+                              404: OpenApiResponse(description='Course or export file not found')},
+                   parameters=[
+                       OpenApiParameter(name='pk', location=OpenApiParameter.PATH, description='Course ID'),
+                       OpenApiParameter(name='export', location=OpenApiParameter.QUERY, required=False, type=str,
+                                        enum=GRADEBOOK_FORMATS),
+                       OpenApiParameter(name='background', location=OpenApiParameter.QUERY, required=False, type=bool,
+                                        description='Write the export to a file in a celery task'),
+                       OpenApiParameter(name='file', location=OpenApiParameter.QUERY, required=False, type=str,
+                                        description='Download a file made by a background export'),
+                   ])
+    @action(detail=True, methods=['get'], url_path='gradebook', permission_classes=[IsAuthenticated, CoLecturerOrAbove])
+    def gradebook(self, request, pk):
+        course = get_object_or_404(Course, pk=pk)
+        check_object_permissions(self, request, course)
+
+        file_name = request.query_params.get('file')
+        if file_name:
+            path = gradebook_export_dir() / file_name
+            if not is_gradebook_file(course.id, file_name) or not path.exists():
+                raise Http404('Export is not ready or does not exist')
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=file_name)
+
+        export_format = request.query_params.get('export', 'csv')
+        if export_format not in GRADEBOOK_FORMATS:
+            raise ValidationError({'export': f'Must be one of {", ".join(GRADEBOOK_FORMATS)}'})
+
+        if query_flag(request, 'background'):
+            file_name = gradebook_file_name(course.id, export_format)
+            export_gradebook.delay(course.id, export_format, file_name)
+            return Response({'file': file_name}, status=status.HTTP_202_ACCEPTED)
+
+        content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        response = StreamingHttpResponse(gradebook_lines(course, export_format), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="gradebook-{course.id}.{export_format}"'
+        return response
+
+    @extend_schema(summary='course leaderboard',
+                   responses={200: OpenApiResponse(description='Top students by summed best test scores, '
+                                                               'with the caller\'s rank and percentile'),
+                              404: OpenApiResponse(description='Course not found')},
+                   parameters=[
+                       OpenApiParameter(name='pk', location=OpenApiParameter.PATH, description='Course ID'),
+                       OpenApiParameter(name='limit', location=OpenApiParameter.QUERY, required=False, type=int),
+                   ])
+    @action(detail=True, methods=['get'], url_path='leaderboard', permission_classes=[IsAuthenticated, StudentOrAbove])
+    def leaderboard(self, request, pk):
+        course = get_object_or_404(Course, pk=pk)
+        check_object_permissions(self, request, course)
+        data = leaderboard(CourseScore.objects.filter(course=course), 'total_score', request.user,
+                           limit=leaderboard_size(request))
+        return Response(data, status=status.HTTP_200_OK)
+
     @extend_schema(summary='kick user from course',
                    request=CourseUserKickSerializer,
                    responses={200: OpenApiResponse(description='User kicked'),
@@ -230,7 +390,6 @@ class CourseViewSet(viewsets.ViewSet):
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         if request.method == 'POST':
-            check_object_permissions(self,request, course)
             serializer = CourseRequestApprovalSerializer(data=request.data, context={'course': course})
 
             if not serializer.is_valid():
@@ -243,6 +402,26 @@ class CourseViewSet(viewsets.ViewSet):
             return Response({'message': f"Task to {new_status} request has been accepted"},
                             status=status.HTTP_202_ACCEPTED)
 
+    @extend_schema(summary='moderate requests in batch',
+                   request=CourseRequestsBatchSerializer,
+                   responses={202: OpenApiResponse(description='Batch accepted'),
+                              400: OpenApiResponse(description='Invalid or already moderated requests'),
+                              404: OpenApiResponse(description='Course not found')},
+                   parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH,
+                                                description='Course ID', required=True, type=int), ]
+                   )
+    @action(detail=True, methods=['post'], url_path='requests/batch',
+            permission_classes=[IsAuthenticated, CoLecturerOrAbove])
+    def moderate_requests_batch(self, request, pk):
+        course = get_object_or_404(Course, pk=pk)
+        check_object_permissions(self, request, course)
+        serializer = CourseRequestsBatchSerializer(data=request.data, context={'course': course})
+        serializer.is_valid(raise_exception=True)
+        decisions = [[d['request_id'], d['new_status']] for d in serializer.validated_data['decisions']]
+        moderate_join_requests.delay(course.id, decisions)
+        return Response({'message': f"Task to moderate {len(decisions)} requests has been accepted"},
+                        status=status.HTTP_202_ACCEPTED)
+
 
 #TESTED
 class CourseSectionsViewSet(viewsets.ViewSet):
@@ -260,15 +439,31 @@ class CourseSectionsViewSet(viewsets.ViewSet):
         parameters=[
             OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, description='courseID', required=True,
                              type=int),
+            OpenApiParameter(name='outline', location=OpenApiParameter.QUERY, required=False, type=bool,
+                             description='Only ids, titles and order of blocks'),
         ],
     )
     def list(self, request, course_pk):
-        course = get_object_or_404(Course, pk=course_pk)
+        course = resolve_course_path(request, course_pk).course
         check_object_permissions(self, request, course)
-        sections = course.course_sections.filter(course=course)
         user = request.user
-        serializer = CourseSectionsSerializer(sections, many=True, context={'user': user, })
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        outline_only = query_flag(request, 'outline')
+        etag, last_modified = course_content_validators(course, user, 'sections', outline_only,
+                                                        with_results=not outline_only)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        context = {'user': user, 'bookmarked_sections': get_bookmarked_sections(user, course)}
+        if outline_only:
+            sections = with_positions(course.course_sections.all()).prefetch_related(
+                Prefetch('section_content', queryset=SectionContent.objects.only(*OUTLINE_BLOCK_FIELDS)))
+            serializer = CourseSectionsOutlineSerializer(sections, many=True, context=context)
+        else:
+            sections = with_positions(course.course_sections.all()).prefetch_related(
+                Prefetch('section_content', queryset=SectionContent.objects.defer('search_vector')))
+            serializer = CourseSectionsSerializer(sections, many=True, context=context)
+        return set_validators(Response(serializer.data, status=status.HTTP_200_OK), etag, last_modified)
 
 
     @extend_schema(summary='Create new section',
@@ -279,7 +474,7 @@ class CourseSectionsViewSet(viewsets.ViewSet):
                                         required=True, type=int)]
                    )
     def create(self, request, course_pk):
-        course = get_object_or_404(Course, pk=course_pk)
+        course = resolve_course_path(request, course_pk).course
         self.check_for_permission(request, course)
         serializer = SectionCreateUpdateSerializer(data=request.data, context={'course': course})
         serializer.is_valid(raise_exception=True)
@@ -297,10 +492,10 @@ class CourseSectionsViewSet(viewsets.ViewSet):
                               404: OpenApiResponse(description='Course not found')}
                    )
     def retrieve(self, request, course_pk, pk):
-        course = get_object_or_404(Course, pk=course_pk)
+        course, section, *_ = resolve_course_path(request, course_pk, pk)
         check_object_permissions(self, request, course)
-        section = get_object_or_404(CourseSections, course=course, pk=pk)
-        serializer = CourseSectionsSerializer(section, context={'user': request.user})
+        serializer = CourseSectionsSerializer(section, context={
+            'user': request.user, 'bookmarked_sections': get_bookmarked_sections(request.user, course)})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
@@ -315,8 +510,7 @@ class CourseSectionsViewSet(viewsets.ViewSet):
                                         required=True, type=int),
                    ], )
     def partial_update(self, request, course_pk, pk):
-        course = get_object_or_404(Course, pk=course_pk)
-        section = get_object_or_404(CourseSections, pk=pk, course=course)
+        course, section, *_ = resolve_course_path(request, course_pk, pk)
         check_object_permissions(self, request, course)
         self.check_for_permission(request, course)
         serializer = SectionCreateUpdateSerializer(section, data=request.data, partial=True)
@@ -334,23 +528,36 @@ class CourseSectionsViewSet(viewsets.ViewSet):
                                         description='ID section', required=True, type=int),
                    ])
     def destroy(self, request, course_pk, pk):
-        course = get_object_or_404(Course, pk=course_pk)
+        course, section, *_ = resolve_course_path(request, course_pk, pk)
         check_object_permissions(self, request, course)
         self.check_for_permission(request, course)
-        course = get_object_or_404(Course, pk=course_pk)
-        section = get_object_or_404(CourseSections, pk=pk, course=course)
         section.delete()
         return Response({'message': 'Section successfully deleted'}, status=status.HTTP_204_NO_CONTENT)
 
 
+    @extend_schema(summary='Reorder sections',
+                   request=ReorderSerializer,
+                   responses={200: CourseSectionsGetSerializer(many=True),
+                              400: OpenApiResponse(description='error message')},
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=int),
+                   ])
+    @action(detail=False, methods=['post'], url_path='reorder')
+    def reorder(self, request, course_pk):
+        course = resolve_course_path(request, course_pk).course
+        check_object_permissions(self, request, course)
+        self.check_for_permission(request, course)
+        serializer = ReorderSerializer(data=request.data, context={'siblings': course.course_sections.all()})
+        serializer.is_valid(raise_exception=True)
+        return Response(CourseSectionsGetSerializer(serializer.save(), many=True).data, status=status.HTTP_200_OK)
+
+
 class CourseBlocksViewSet(viewsets.ViewSet):
     authentication_classes = (JWTAuthentication,)
     permission_classes = (IsAuthenticated, Student)
 
     def get_crs_sct(self, course_pk, section_pk):
-        course = get_object_or_404(Course, pk=course_pk)
-        section = get_object_or_404(CourseSections, pk=section_pk, course=course)
-
+        course, section, *_ = resolve_course_path(self.request, course_pk, section_pk)
         return course, section
 
     @extend_schema(summary='Get course blocks',
@@ -363,7 +570,7 @@ class CourseBlocksViewSet(viewsets.ViewSet):
     def list(self, request, course_pk, pk, *args, **kwargs):
         course, section = self.get_crs_sct(course_pk, pk)
         check_object_permissions(self, request, course)
-        blocks = SectionContent.objects.filter(section=section).order_by('order')
+        blocks = with_positions(SectionContent.objects.filter(section=section)).order_by('order')
         serializer = SectionContentSerializer(blocks, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -376,12 +583,11 @@ class CourseBlocksViewSet(viewsets.ViewSet):
                        OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=int),
                    ])
     def retrieve(self, request, course_pk, section_pk, pk):
-        course, section = self.get_crs_sct(course_pk, section_pk)
+        course, section, block, *_ = resolve_course_path(request, course_pk, section_pk, pk)
         check_object_permissions(self, request, course)
-        block = get_object_or_404(SectionContent, pk=pk, section=section)
         user = request.user
         if CoLecturerOrAbove().has_object_permission(request, self, course):
-            serializer = AdminSectionContentMultiSerializer(block)
+            serializer = AdminSectionContentMultiSerializer(block, context={'user': user})
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         else:
@@ -420,7 +626,7 @@ class CourseBlocksViewSet(viewsets.ViewSet):
             serializer = SectionTestCreateUpdateSerializer(data=request.data, context={'section': section})
             serializer.is_valid(raise_exception=True)
             serializer.save()
-            output_serializer = TestBlockGetUpdateSerializer(serializer.instance)
+            output_serializer = TestBlockGetUpdateSerializer(serializer.instance, context={'user': request.user})
             return Response(output_serializer.data, status=status.HTTP_201_CREATED)
         return Response({'message': 'error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -434,11 +640,10 @@ class CourseBlocksViewSet(viewsets.ViewSet):
                        OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=int),
                    ])
     def partial_update(self, request, course_pk, section_pk, pk):
-        course, section = self.get_crs_sct(course_pk, section_pk)
+        course, section, block, *_ = resolve_course_path(request, course_pk, section_pk, pk)
         check_object_permissions(self, request, course)
         if not CoLecturerOrAbove().has_object_permission(request, self, course):
             raise PermissionDenied("Only CoLecturerOrAbove can update sections")
-        block = get_object_or_404(SectionContent, pk=pk, section=section)
 
         if block.content_type == 'lection':
             serializer = SectionContentCreateUpdateSerializer(block, partial=True, data=request.data,
@@ -457,7 +662,7 @@ class CourseBlocksViewSet(viewsets.ViewSet):
             serializer = TestBlockGetUpdateSerializer(test, data=request.data, context=context, partial=True)
             serializer.is_valid(raise_exception=True)
             serializer.save()
-            output_serializer = TestBlockGetUpdateSerializer(serializer.instance)
+            output_serializer = TestBlockGetUpdateSerializer(serializer.instance, context={'user': request.user})
             return Response(output_serializer.data, status=status.HTTP_200_OK)
 
     @extend_schema(summary='Delete section block',
@@ -468,12 +673,11 @@ class CourseBlocksViewSet(viewsets.ViewSet):
                        OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=int),
                    ])
     def destroy(self, request, course_pk, section_pk, pk):
-        course, section = self.get_crs_sct(course_pk, section_pk)
+        course, section, content, *_ = resolve_course_path(request, course_pk, section_pk, pk)
         check_object_permissions(self, request, course)
         if not CoLecturerOrAbove().has_object_permission(request, self, course):
             raise PermissionDenied("Only CoLecturerOrAbove can delete sections")
         with transaction.atomic():
-            content = get_object_or_404(SectionContent, pk=pk, section=section)
             if content.content_type == 'lection':
                 content.delete()
             elif content.content_type == 'test':
@@ -485,6 +689,24 @@ class CourseBlocksViewSet(viewsets.ViewSet):
         return Response(updated_section, status=status.HTTP_200_OK)
 
 
+    @extend_schema(summary='Reorder section blocks',
+                   request=ReorderSerializer,
+                   responses={200: SectionContentSerializer(many=True),
+                              400: OpenApiResponse(description='error message')},
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=int),
+                       OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=int),
+                   ])
+    @action(detail=False, methods=['post'], url_path='reorder')
+    def reorder(self, request, course_pk, section_pk):
+        course, section = self.get_crs_sct(course_pk, section_pk)
+        check_object_permissions(self, request, course)
+        if not CoLecturerOrAbove().has_object_permission(request, self, course):
+            raise PermissionDenied("Only CoLecturerOrAbove can reorder blocks")
+        serializer = ReorderSerializer(data=request.data, context={'siblings': section.section_content.all()})
+        serializer.is_valid(raise_exception=True)
+        return Response(SectionContentSerializer(serializer.save(), many=True).data, status=status.HTTP_200_OK)
+
 
 class SectionsSwap(APIView):
     authentication_classes = [JWTAuthentication]
@@ -498,9 +720,8 @@ class SectionsSwap(APIView):
                        OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=int),
                    ])
     def post(self, request, course_pk, *args, **kwargs):
-        course = get_object_or_404(Course, pk=course_pk)
+        course = resolve_course_path(request, course_pk).course
         check_object_permissions(self, request, course)
-        CoLecturerOrAbove().has_object_permission(request, self, course)
 
         from_section = request.data.get('from_section')
         to_section = request.data.get('to_section')
@@ -511,19 +732,11 @@ class SectionsSwap(APIView):
         except (ValueError, TypeError):
             return Response({'error': 'Invalid sections(order)'}, status=status.HTTP_400_BAD_REQUEST)
 
-        section_1 = get_object_or_404(CourseSections, order=from_section, course=course)
-        section_2 = get_object_or_404(CourseSections, order=to_section, course=course)
-
-        with transaction.atomic():
-
-            section_1.order = 999
-            section_1.save()
-
-            section_2.order = from_section
-            section_2.save()
-
-            section_1.order = to_section
-            section_1.save()
+        # from_section / to_section are positions
+        section_1 = sibling_at(course.course_sections.all(), from_section)
+        section_2 = sibling_at(course.course_sections.all(), to_section)
+        swap_ranks(section_1, section_2)
+        section_1.position, section_2.position = section_2.position, section_1.position
 
         output_serializer = CourseSectionsGetSerializer(sorted([section_2, section_1],
                                                                key=lambda x: x.order), many=True)
@@ -543,10 +756,8 @@ class SectionBlockSwap(APIView):
                        OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=int),
                    ])
     def post(self, request, course_pk, section_pk, *args, **kwargs):
-        course = get_object_or_404(Course, pk=course_pk)
+        course, section, *_ = resolve_course_path(request, course_pk, section_pk)
         check_object_permissions(self, request, course)
-        CoLecturerOrAbove().has_object_permission(request, self, course)
-        section = get_object_or_404(CourseSections, course=course, pk=section_pk)
 
         try:
             from_block = int(request.data.get('from_block'))
@@ -558,23 +769,13 @@ class SectionBlockSwap(APIView):
             raise ValidationError('You can\'t swap between same blocks')
 
         try:
-            block_from = SectionContent.objects.get(order=from_block, section=section)
-            block_to = SectionContent.objects.get(order=to_block, section=section)
-        except SectionContent.DoesNotExist as e:
-            return Response({'error': f'Blocks  {str(e)} not found'}, status=status.HTTP_400_BAD_REQUEST)
-
-        with transaction.atomic():
-            block1 = block_from.order
-            block2 = block_to.order
-
-            block_from.order = 999
-            block_from.save()
-
-            block_to.order = block1
-            block_to.save()
+            block_from = sibling_at(section.section_content.all(), from_block)
+            block_to = sibling_at(section.section_content.all(), to_block)
+        except Http404:
+            return Response({'error': 'Blocks not found'}, status=status.HTTP_400_BAD_REQUEST)
 
-            block_from.order = block2
-            block_from.save()
+        swap_ranks(block_from, block_to)
+        block_from.position, block_to.position = block_to.position, block_from.position
 
         output_serializer = SectionContentSerializer(sorted([block_to, block_from],
                                                             key=lambda x: x.order), many=True)
@@ -1,6 +1,8 @@
 from rest_framework import permissions
 from rest_framework.permissions import BasePermission
 
+from courses_app.utils import get_course_role
+
 #SITE PERMISSIONS
 class RolePermission(permissions.BasePermission):
     allowed_roles=[]
@@ -31,8 +33,9 @@ class CourseRolePermissions(permissions.BasePermission):
     allowed_roles = []
 
     def has_object_permission(self, request, view,obj):
-        user_roles =obj.course_roles.filter(user=request.user).values_list('course_role', flat=True)
-        return any(role in self.allowed_roles for role in user_roles) or request.user.role in ['staff'] or request.user.is_superuser
+        if request.user.role in ['staff'] or request.user.is_superuser:
+            return True
+        return get_course_role(request, obj) in self.allowed_roles
 
 
 class Student(CourseRolePermissions):
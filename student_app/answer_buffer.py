@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from courses_app.models import TestQuestions
+from student_app.models import TestUserAnswers
+
+ANSWER_BUFFER_TIMEOUT = 60 * 60 * 24
+
+
+def write_behind_enabled():
+    return getattr(settings, 'TEST_ANSWERS_WRITE_BEHIND', False)
+
+
+def selection_key(session_uuid, question_id):
+    return f'answer-buffer:{session_uuid}:q{question_id}'
+
+
+# every buffered write increments :rev, a flush stores the rev it wrote as :flushed
+def revision_key(session_uuid):
+    return f'answer-buffer:{session_uuid}:rev'
+
+
+def flushed_key(session_uuid):
+    return f'answer-buffer:{session_uuid}:flushed'
+
+
+def replace_session_answers(session, selections):
+    """Replaces the session's answers to the given questions ({question_id: answer ids}) in bulk"""
+    answered = [question_id for question_id, selected in selections.items() if selected]
+    SelectedAnswer = TestUserAnswers.selected_answers.through
+
+    with transaction.atomic():
+        TestUserAnswers.objects.filter(session=session, question_id__in=selections) \
+            .exclude(question_id__in=answered).delete()
+        user_answers = TestUserAnswers.objects.bulk_create(
+            [TestUserAnswers(session=session, question_id=question_id) for question_id in answered],
+            update_conflicts=True, unique_fields=['session', 'question'], update_fields=['answered_at'])
+        SelectedAnswer.objects.filter(testuseranswers__in=[user_answer.id for user_answer in user_answers]) \
+            .delete()
+        SelectedAnswer.objects.bulk_create([
+            SelectedAnswer(testuseranswers_id=user_answer.id, testanswers_id=answer_id)
+            for user_answer in user_answers for answer_id in selections[user_answer.question_id]])
+
+
+def buffer_answers(session, selections):
+    """
+    Keeps the selections ({question_id: answer ids}) in the cache instead of writing them.
+    Nothing drops the keys of a finished session anymore, so callers check the session is open
+    under its row lock (see student_app.views.lock_answerable_session).
+    """
+    if session.is_finished:
+        return
+    cache.set_many({selection_key(session.uuid, question_id): sorted(selected)
+                    for question_id, selected in selections.items()}, ANSWER_BUFFER_TIMEOUT)
+    cache.add(revision_key(session.uuid), 0, ANSWER_BUFFER_TIMEOUT)
+    cache.incr(revision_key(session.uuid))
+
+
+def buffered_selection(session, question_id):
+    """Answer ids buffered for the question, None when nothing is buffered"""
+    if not write_behind_enabled() or session.is_finished:
+        return None
+    return cache.get(selection_key(session.uuid, question_id))
+
+
+def read_buffer(session_uuid, question_ids):
+    keys = {selection_key(session_uuid, question_id): question_id for question_id in question_ids}
+    return {keys[key]: set(selected) for key, selected in cache.get_many(keys).items()}
+
+
+def flush_session_buffer(session, question_ids=None, final=False):
+    """
+    Writes buffered selections of the session to TestUserAnswers if they changed since the
+    last flush. final drops the buffer afterwards, use it once the session can't change anymore.
+    """
+    if not write_behind_enabled():
+        return
+    if question_ids is None:
+        question_ids = list(TestQuestions.objects.filter(test_block_id=session.test_block_id)
+                            .values_list('id', flat=True))
+    state = cache.get_many([revision_key(session.uuid), flushed_key(session.uuid)])
+    revision = state.get(revision_key(session.uuid))
+    if revision is not None and revision != state.get(flushed_key(session.uuid)):
+        selections = read_buffer(session.uuid, question_ids)
+        if selections:
+            replace_session_answers(session, selections)
+        cache.set(flushed_key(session.uuid), revision, ANSWER_BUFFER_TIMEOUT)
+    if final:
+        cache.delete_many([selection_key(session.uuid, question_id) for question_id in question_ids]
+                          + [revision_key(session.uuid), flushed_key(session.uuid)])
@@ -3,7 +3,7 @@ import uuid
 from django.db import models
 from django.utils import timezone
 
-from courses_app.models import TestBlock, TestQuestions, TestAnswers
+from courses_app.models import Course, TestBlock, TestQuestions, TestAnswers
 from main.models import SiteUser
 
 
@@ -17,6 +17,16 @@ class TestSession(models.Model):
     finished_at = models.DateTimeField(null=True, blank=True)
     is_finished = models.BooleanField(default=False)
     summary_score = models.FloatField(default=0)
+    deadline_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the deadline sweeper only looks at open sessions
+            models.Index(fields=['deadline_at'], condition=models.Q(is_finished=False),
+                         name='session_open_deadline_idx'),
+            # per student results of a test, see grading.student_results
+            models.Index(fields=['test_block', 'user'], name='session_test_user_idx'),
+        ]
 
     def time_left(self):
         from datetime import timedelta
@@ -24,7 +34,7 @@ class TestSession(models.Model):
         if self.finished_at is not None:
             return timedelta(seconds=0)
 
-        end_time = self.started_at + self.test_block.time_for_test
+        end_time = self.deadline_at or self.started_at + self.test_block.time_for_test
         remaining_time = end_time - timezone.now()
 
         return max(remaining_time, timedelta(seconds=0))
@@ -35,4 +45,41 @@ class TestUserAnswers(models.Model):
     question = models.ForeignKey(TestQuestions, on_delete=models.CASCADE,related_name='answers')
     selected_answers = models.ManyToManyField(TestAnswers)
     answered_at = models.DateTimeField(auto_now_add=True)
-    score = models.FloatField(default=1)
\ No newline at end of file
+    score = models.FloatField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'question'], name='unique_session_question_answer'),
+        ]
+
+class TestScore(models.Model):
+    """Best finished score of a user in a test, kept up to date by grading.close_session"""
+    test_block = models.ForeignKey(TestBlock, on_delete=models.CASCADE, related_name='scores')
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='test_scores')
+    user = models.ForeignKey(SiteUser, on_delete=models.CASCADE, related_name='test_scores')
+    best_score = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['test_block', 'user'], name='unique_test_score'),
+        ]
+        indexes = [
+            models.Index('test_block', models.F('best_score').desc(), name='test_score_rank_idx'),
+        ]
+
+
+class CourseScore(models.Model):
+    """Sum of a user's TestScore.best_score over the tests of a course"""
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='scores')
+    user = models.ForeignKey(SiteUser, on_delete=models.CASCADE, related_name='course_scores')
+    total_score = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['course', 'user'], name='unique_course_score'),
+        ]
+        indexes = [
+            models.Index('course', models.F('total_score').desc(), name='course_score_rank_idx'),
+        ]
@@ -1,9 +1,15 @@
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.db import transaction
+from django.db.models import Prefetch, Q
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
 from rest_framework.generics import get_object_or_404
 
 from courses_app.models import Course, SectionsBookmarks, TestQuestions
+from courses_app.ordering import PositionField, PositionedListSerializer, with_positions
 from courses_app.utils import assign_role
+from student_app.answer_buffer import write_behind_enabled, buffer_answers, replace_session_answers, \
+    buffered_selection, read_buffer
 from student_app.models import TestSession, TestUserAnswers
 from teacher_app.serializers import TestAnswerSerializer, TestSessionAnswerSerializer
 
@@ -63,25 +69,56 @@ class CodeJoinCourseSerializer(serializers.ModelSerializer):
             assign_role(user, course)
         return data
 
-class TestWithSelectedAnswersSerializer(serializers.ModelSerializer):
-    test_answers = TestSessionAnswerSerializer(many=True, read_only=True)
-    selected_answers = serializers.SerializerMethodField()
-
-    class Meta:
-        model = TestQuestions
-        fields = ['id', 'order', 'test_question' ,'test_answers','selected_answers']
+def session_questions(session):
+    """
+    Questions of the session's test with their answers and the session's selected answer ids
+    prefetched, three queries for the whole test
+    """
+    selections = TestUserAnswers.objects.filter(session=session).annotate(
+        selected_ids=ArrayAgg('selected_answers', filter=Q(selected_answers__isnull=False), default=[]))
+    questions = with_positions(TestQuestions.objects.filter(test_block_id=session.test_block_id))
+    return questions.order_by('order').prefetch_related(
+        'test_answers', Prefetch('answers', queryset=selections, to_attr='session_answers'))
+
+
+class SelectedAnswersMixin:
+    answer_serializer_class = TestSessionAnswerSerializer
+
+    def get_selected_answer_ids(self, session, question):
+        # write-behind selections win over the db, read in bulk by the parent serializer when given
+        buffered = self.context.get('buffered_selections')
+        if buffered is None:
+            selection = buffered_selection(session, question.id)
+            if selection is not None:
+                return set(selection)
+        elif question.id in buffered:
+            return buffered[question.id]
+        if hasattr(question, 'session_answers'):
+            return set(question.session_answers[0].selected_ids) if question.session_answers else set()
+        return set(TestUserAnswers.selected_answers.through.objects
+                   .filter(testuseranswers__session=session, testuseranswers__question=question)
+                   .values_list('testanswers_id', flat=True))
 
     def get_selected_answers(self, obj):
         session = self.context.get('session')
         if not session:
             return []
-        try:
-            user_answers = TestUserAnswers.objects.get(session=session,question=obj)
-        except TestUserAnswers.DoesNotExist:
+        selected_ids = self.get_selected_answer_ids(session, obj)
+        if not selected_ids:
             return []
+        selected = [answer for answer in obj.test_answers.all() if answer.id in selected_ids]
+        return self.answer_serializer_class(selected, many=True).data
+
 
-        serializer = TestSessionAnswerSerializer(user_answers.selected_answers.all(), many=True)
-        return serializer.data
+class TestWithSelectedAnswersSerializer(SelectedAnswersMixin, serializers.ModelSerializer):
+    order = PositionField()
+    test_answers = TestSessionAnswerSerializer(many=True, read_only=True)
+    selected_answers = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TestQuestions
+        fields = ['id', 'order', 'test_question' ,'test_answers','selected_answers']
+        list_serializer_class = PositionedListSerializer
 
 
 class TestAnswersValidationSerializer(serializers.Serializer):
@@ -98,6 +135,47 @@ class TestAnswersValidationSerializer(serializers.Serializer):
         return data
 
 
+class SubmittedAnswerSerializer(serializers.Serializer):
+    question = serializers.IntegerField()
+    selected_answer = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+
+class SessionAnswersBulkSerializer(serializers.Serializer):
+    answers = SubmittedAnswerSerializer(many=True, required=False, default=list)
+
+    def validate_answers(self, value):
+        session = self.context.get('session')
+        questions = {}
+        for question_id, answers_type, answer_id in TestQuestions.objects.filter(test_block_id=session.test_block_id) \
+                .values_list('id', 'test_answers_type', 'test_answers__id'):
+            question = questions.setdefault(question_id, (answers_type, set()))
+            if answer_id is not None:
+                question[1].add(answer_id)
+
+        # {question_id: selected answer ids}, a question sent twice keeps the last selection
+        selections = {}
+        for submitted in value:
+            if submitted['question'] not in questions:
+                raise NotFound(f"Question {submitted['question']} not found in this test")
+            answers_type, answer_ids = questions[submitted['question']]
+            selected = submitted['selected_answer']
+            if len(selected) > len(answer_ids):
+                raise serializers.ValidationError('Too many answers')
+            if len(selected) > 1 and answers_type == "single":
+                raise serializers.ValidationError('Its a single answer test')
+            selections[submitted['question']] = answer_ids.intersection(selected)
+        return selections
+
+    def save(self, **kwargs):
+        """Replaces the session's answers to the submitted questions in a fixed number of queries"""
+        session = self.context.get('session')
+        if write_behind_enabled():
+            buffer_answers(session, self.validated_data['answers'])
+        else:
+            replace_session_answers(session, self.validated_data['answers'])
+        return session
+
+
 class SessionTestSerializer(serializers.ModelSerializer):
     test = serializers.SerializerMethodField()
     time_left = serializers.SerializerMethodField()
@@ -110,30 +188,24 @@ class SessionTestSerializer(serializers.ModelSerializer):
         return int(obj.time_left().total_seconds())
 
     def get_test(self, obj):
-        questions = obj.test_block.questions.all().order_by('order')
-        session = obj
-        return TestWithSelectedAnswersSerializer(questions, many=True,context={'session':session}).data
+        questions = list(session_questions(obj))
+        context = {'session': obj}
+        if write_behind_enabled() and not obj.is_finished:
+            context['buffered_selections'] = read_buffer(obj.uuid, [question.id for question in questions])
+        return TestWithSelectedAnswersSerializer(questions, many=True, context=context).data
 
 
-class TestResultsWithSelectedAnswersSerializer(serializers.ModelSerializer):
+class TestResultsWithSelectedAnswersSerializer(SelectedAnswersMixin, serializers.ModelSerializer):
+    answer_serializer_class = TestAnswerSerializer
+    order = PositionField()
     test_answers = TestAnswerSerializer(many=True, read_only=True)
     selected_answers = serializers.SerializerMethodField()
 
     class Meta:
         model = TestQuestions
         fields = ['id', 'order', 'test_question' ,'test_answers','selected_answers']
+        list_serializer_class = PositionedListSerializer
 
-    def get_selected_answers(self, obj):
-        session = self.context.get('session')
-        if not session:
-            return []
-        try:
-            user_answers = TestUserAnswers.objects.get(session=session,question=obj)
-        except TestUserAnswers.DoesNotExist:
-            return []
-
-        serializer = TestAnswerSerializer(user_answers.selected_answers.all(), many=True)
-        return serializer.data
 
 class TestSessionResultsSerializer(serializers.ModelSerializer):
     test = serializers.SerializerMethodField()
@@ -147,7 +219,5 @@ class TestSessionResultsSerializer(serializers.ModelSerializer):
         return obj.time_left().total_seconds()
 
     def get_test(self, obj):
-        questions = obj.test_block.questions.all().order_by('order')
-        session = obj
-        return TestResultsWithSelectedAnswersSerializer(questions, many=True,context={'session':session}).data
-
+        return TestResultsWithSelectedAnswersSerializer(session_questions(obj), many=True,
+                                                        context={'session': obj}).data
@@ -1,3 +1,255 @@
-from django.test import TestCase
+import io
+from datetime import timedelta
 
-# Create your tests here.
+import pytest
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
+
+from Learning_platform import tasks
+from courses_app import grading
+from courses_app.grading import grade_session, finish_session, sweep_expired_sessions
+from student_app.answer_buffer import revision_key
+from student_app.models import TestSession, TestUserAnswers, CourseScore
+from student_app.serializers import SessionAnswersBulkSerializer, SessionTestSerializer, \
+    TestSessionResultsSerializer
+from teacher_app.serializers import TestCreateUpdateSerializer
+
+from conftest import *
+
+
+def answer(session, question, *orders):
+    user_answer = TestUserAnswers.objects.create(session=session, question=question)
+    user_answer.selected_answers.set(question.test_answers.filter(order__in=orders))
+    return user_answer
+
+
+@pytest.mark.django_db
+def test_grade_session_in_constant_queries(exam, user_student, django_assert_num_queries):
+    single, multiple, double = exam.questions.all()
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+    answer(session, single, 1)
+    answer(session, multiple, 1)
+    answer(session, double, 2)
+
+    with django_assert_num_queries(3):
+        assert grade_session(session) == 3
+    assert dict(TestUserAnswers.objects.values_list('question__order', 'score')) == {1: 1, 2: 0, 3: 2}
+
+    TestUserAnswers.objects.filter(session=session).delete()
+    answer(session, multiple, 1, 2)
+    answer(session, double)
+    # the compiled answer key is reused
+    with django_assert_num_queries(2):
+        assert grade_session(session) == 1
+
+
+@pytest.mark.django_db
+def test_answer_key_revision_follows_question_edits(exam, user_student):
+    single = exam.questions.get(order=1)
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+    answer(session, single, 1)
+    assert grade_session(session) == 1
+
+    serializer = TestCreateUpdateSerializer(single, partial=True, data={'test_answers_type': 'single', 'test_answers': [
+        {'order': 1, 'answer_text': 'a1', 'is_correct': False},
+        {'order': 2, 'answer_text': 'a2', 'is_correct': True}]})
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+
+    session = TestSession.objects.select_related('test_block').get(pk=session.pk)
+    assert session.test_block.answer_key_revision == exam.answer_key_revision + 1
+    assert grade_session(session) == 0
+
+
+@pytest.mark.django_db
+def test_submit_stores_score(student_with_auth, exam, user_student):
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+    answer(session, exam.questions.get(order=3), 2)
+    response = student_with_auth.post(f'/tests/{session.uuid}/submit/')
+    assert response.status_code == 200
+    assert response.data['score'] == 2
+    session.refresh_from_db()
+    assert session.is_finished and session.summary_score == 2
+
+
+@pytest.mark.django_db
+def test_bulk_answers_upserted(student_with_auth, exam, user_student, django_assert_max_num_queries):
+    single, multiple, double = exam.questions.all()
+    ids = {question.order: list(question.test_answers.values_list('id', flat=True)) for question in exam.questions.all()}
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+
+    payload = {'answers': [{'question': single.id, 'selected_answer': ids[1][:1]},
+                           {'question': multiple.id, 'selected_answer': ids[2][:2]}]}
+    response = student_with_auth.post(f'/tests/{session.uuid}/', payload, format='json')
+    assert response.status_code == 202
+
+    payload = {'answers': [{'question': single.id, 'selected_answer': []},
+                           {'question': multiple.id, 'selected_answer': ids[2][1:]},
+                           {'question': double.id, 'selected_answer': ids[3][1:]}]}
+    serializer = SessionAnswersBulkSerializer(data=payload, context={'session': session})
+    with django_assert_max_num_queries(9):
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+    selected = {user_answer.question_id: set(user_answer.selected_answers.values_list('id', flat=True))
+                for user_answer in TestUserAnswers.objects.filter(session=session)}
+    assert selected == {multiple.id: set(ids[2][1:]), double.id: set(ids[3][1:])}
+
+    payload = {'answers': [{'question': single.id, 'selected_answer': ids[1]}]}
+    response = student_with_auth.post(f'/tests/{session.uuid}/', payload, format='json')
+    assert response.status_code == 400
+
+    # no answers is a valid (empty) submission
+    response = student_with_auth.post(f'/tests/{session.uuid}/', {}, format='json')
+    assert response.status_code == 202
+
+
+@pytest.mark.django_db
+def test_answers_rejected_after_deadline(student_with_auth, exam, user_student, user_teacher_approved):
+    single = exam.questions.get(order=1)
+    payload = {'selected_answers': [single.test_answers.get(order=1).id]}
+    other = TestSession.objects.create(test_block=exam, user=user_teacher_approved)
+    assert student_with_auth.post(f'/tests/{other.uuid}/?question=1', payload, format='json').status_code == 403
+
+    session = TestSession.objects.create(test_block=exam, user=user_student,
+                                         deadline_at=timezone.now() - timedelta(seconds=1))
+    response = student_with_auth.post(f'/tests/{session.uuid}/?question=1', payload, format='json')
+    assert response.status_code == 400
+    # finished on access instead of waiting for the sweeper
+    session.refresh_from_db()
+    assert session.is_finished and not TestUserAnswers.objects.filter(session=session).exists()
+    response = student_with_auth.post(f'/tests/{session.uuid}/', {'answers': []}, format='json')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_write_behind_answers_flushed_on_submit(student_with_auth, exam, user_student, settings):
+    settings.TEST_ANSWERS_WRITE_BEHIND = True
+    single, multiple, double = exam.questions.all()
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+    correct = double.test_answers.get(order=2)
+
+    response = student_with_auth.post(f'/tests/{session.uuid}/?question=3', {'selected_answers': [correct.id]},
+                                      format='json')
+    assert response.status_code == 200
+    assert [a['id'] for a in response.data['selected_answers']] == [correct.id]
+    assert not TestUserAnswers.objects.filter(session=session).exists()
+
+    assert tasks.flush_answer_buffers() == 'Checked 1 sessions'
+    assert list(TestUserAnswers.objects.get(session=session).selected_answers.all()) == [correct]
+
+    student_with_auth.post(f'/tests/{session.uuid}/?question=1',
+                           {'selected_answers': [single.test_answers.get(order=1).id]}, format='json')
+    response = student_with_auth.post(f'/tests/{session.uuid}/submit/')
+    assert response.data['score'] == 3
+    assert TestUserAnswers.objects.filter(session=session).count() == 2
+
+    # nothing is buffered for a finished session, the keys would never be dropped
+    response = student_with_auth.post(f'/tests/{session.uuid}/?question=3', {'selected_answers': []},
+                                      format='json')
+    assert response.status_code == 400
+    assert cache.get(revision_key(session.uuid)) is None
+
+
+@pytest.mark.django_db
+def test_sweeper_finishes_expired_sessions_once(student_with_auth, exam, user_student):
+    response = student_with_auth.post(f'/test/{exam.id}/')
+    assert response.status_code == 201
+    session = TestSession.objects.get(uuid=response.data['uuid'])
+    assert session.deadline_at is not None
+    answer(session, exam.questions.get(order=3), 2)
+
+    assert sweep_expired_sessions() == 0
+    TestSession.objects.filter(pk=session.pk).update(deadline_at=timezone.now() - timedelta(seconds=1))
+    assert sweep_expired_sessions(batch_size=1) == 1
+    session.refresh_from_db()
+    assert session.is_finished and session.summary_score == 2
+
+    assert finish_session(session.pk) is None
+    response = student_with_auth.post(f'/tests/{session.uuid}/submit/')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_sweeper_skips_sessions_that_fail(exam, user_student, user_teacher_approved, monkeypatch):
+    expired = timezone.now() - timedelta(seconds=1)
+    broken = TestSession.objects.create(test_block=exam, user=user_student, deadline_at=expired)
+    other = TestSession.objects.create(test_block=exam, user=user_teacher_approved, deadline_at=expired)
+
+    close_session = grading.close_session
+
+    def failing_close(session):
+        if session.pk == broken.pk:
+            raise RuntimeError('grading failed')
+        return close_session(session)
+
+    monkeypatch.setattr(grading, 'close_session', failing_close)
+    assert sweep_expired_sessions(batch_size=1) == 1
+    broken.refresh_from_db()
+    other.refresh_from_db()
+    assert not broken.is_finished and other.is_finished
+
+
+@pytest.mark.django_db
+def test_session_payload_query_count(exam, user_student, django_assert_num_queries):
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+    single, multiple, double = exam.questions.all()
+    answer(session, multiple, 1, 2)
+    answer(session, double)
+
+    with django_assert_num_queries(3):
+        data = SessionTestSerializer(session).data
+    assert [[a['order'] for a in q['selected_answers']] for q in data['test']] == [[], [1, 2], []]
+
+    session.is_finished = True
+    with django_assert_num_queries(3):
+        data = TestSessionResultsSerializer(session).data
+    assert [len(q['test_answers']) for q in data['test']] == [2, 3, 2]
+    assert data['test'][1]['selected_answers'][0]['is_correct'] is True
+
+
+@pytest.mark.django_db
+def test_leaderboard_follows_finished_sessions(student_with_auth, exam, user_student):
+    course = exam.section.section.course
+    rivals = []
+    for i, score in enumerate([4, 1]):
+        rival = SiteUser.objects.create_student(username=f'rival{i}', password='1234')
+        CourseRoles.objects.create(course=course, user=rival, course_role='student')
+        rival_session = TestSession.objects.create(test_block=exam, user=rival)
+        answer(rival_session, exam.questions.get(order=1), 1)
+        if score == 4:
+            answer(rival_session, exam.questions.get(order=2), 1, 2)
+            answer(rival_session, exam.questions.get(order=3), 2)
+        finish_session(rival_session.pk)
+        rivals.append(rival)
+
+    session = TestSession.objects.create(test_block=exam, user=user_student)
+    answer(session, exam.questions.get(order=3), 2)
+    student_with_auth.post(f'/tests/{session.uuid}/submit/')
+    # a worse retry does not lower the best score
+    retry = TestSession.objects.create(test_block=exam, user=user_student)
+    student_with_auth.post(f'/tests/{retry.uuid}/submit/')
+    assert CourseScore.objects.get(course=course, user=user_student).total_score == 2
+
+    response = student_with_auth.get(f'/courses/{course.id}/leaderboard/', {'limit': 2})
+    assert response.status_code == 200
+    assert response.data['participants'] == 3
+    assert [row['username'] for row in response.data['top']] == ['rival0', 'student']
+    assert response.data['me'] == {'rank': 2, 'score': 2, 'percentile': pytest.approx(66.7)}
+
+    url = f'/courses/{course.id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/leaderboard/'
+    response = student_with_auth.get(url)
+    assert [row['rank'] for row in response.data['top']] == [1, 2, 3]
+
+    CourseScore.objects.all().delete()
+    call_command('rebuild_leaderboards', course.id, stdout=io.StringIO())
+    assert dict(CourseScore.objects.values_list('user__username', 'total_score')) == \
+        {'rival0': 4, 'rival1': 1, 'student': 2}
+
+    # former members drop out of the ranking, deleted attempts out of the scores
+    CourseRoles.objects.filter(course=course, user=rivals[1]).delete()
+    TestSession.objects.filter(user=rivals[0]).delete()
+    assert CourseScore.objects.get(course=course, user=rivals[0]).total_score == 0
+    response = student_with_auth.get(f'/courses/{course.id}/leaderboard/')
+    assert response.data['participants'] == 2
+    assert [row['username'] for row in response.data['top']] == ['student', 'rival0']
@@ -2,6 +2,7 @@ from datetime import datetime
 
 import uuid
 from django.db import transaction
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from drf_spectacular.types import OpenApiTypes
@@ -13,13 +14,15 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
-from Learning_platform.tasks import finish_test
 from courses_app.models import TestBlock, TestQuestions, TestAnswers, Course
-from courses_app.utils import check_test_results, check_object_permissions
+from courses_app.grading import finish_session
+from courses_app.ordering import sibling_at, siblings_of
+from courses_app.utils import check_object_permissions
 from main.permissions import StudentOrAbove
+from student_app.answer_buffer import write_behind_enabled, buffer_answers
 from student_app.models import TestSession, TestUserAnswers
 from student_app.serializers import SessionTestSerializer, TestWithSelectedAnswersSerializer, \
-    TestAnswersValidationSerializer, TestSessionResultsSerializer
+    TestAnswersValidationSerializer, TestSessionResultsSerializer, SessionAnswersBulkSerializer
 
 
 @extend_schema(summary="test session start",
@@ -33,9 +36,8 @@ class TestSessionCreateView(APIView):
     permission_classes = (IsAuthenticated,StudentOrAbove)
 
     def post(self, request, pk=None):
-        test = get_object_or_404(TestBlock, pk=pk)
-        course_id = test.section.section.course.id
-        course = get_object_or_404(Course, id=course_id)
+        test = get_object_or_404(TestBlock.objects.select_related('section__section__course'), pk=pk)
+        course = test.section.section.course
         check_object_permissions(self, request, course)
         existed_sessions = TestSession.objects.filter(test_block=test, user=request.user)
 
@@ -46,13 +48,44 @@ class TestSessionCreateView(APIView):
             return Response({"detail":"You already have test session: ","uuid":str(active_session.uuid)},
                             status=status.HTTP_406_NOT_ACCEPTABLE)
 
-        session= TestSession.objects.create(test_block=test, user=request.user, is_finished=False)
-
-        test_duration = test.time_for_test
-        finish_test.apply_async(args=[str(session.uuid)], countdown=test_duration.total_seconds())
+        # finished by the finish_expired_sessions sweeper once the deadline passes
+        session= TestSession.objects.create(test_block=test, user=request.user, is_finished=False,
+                                            deadline_at=timezone.now() + test.time_for_test)
         return Response({"detail":"Test session started", "uuid": session.uuid},status=status.HTTP_201_CREATED)
 
 
+def expired(session):
+    return not session.is_finished and session.deadline_at is not None and session.deadline_at <= timezone.now()
+
+
+def answerable_session(request, pk):
+    """
+    The caller's session if answers may still be written to it. One past its deadline is finished
+    right here, so grading never waits for the finish_expired_sessions sweeper.
+    """
+    session = get_object_or_404(TestSession.objects.select_related('test_block'), pk=pk)
+    if session.user_id != request.user.id:
+        raise PermissionDenied("You don't have permission to answer in this session")
+    if expired(session):
+        finish_session(session.pk)
+        raise ValidationError("Time for this test is over")
+    if session.is_finished:
+        raise ValidationError(f"Test already finished at {session.finished_at}")
+    return session
+
+
+def lock_answerable_session(session):
+    """
+    Locks the session row for an answer write, call it inside the writing transaction.
+    Closing the session takes the same lock, so no write lands after grading.
+    """
+    open_session = TestSession.objects.select_for_update(of=('self',)) \
+        .filter(pk=session.pk, is_finished=False) \
+        .filter(Q(deadline_at__isnull=True) | Q(deadline_at__gt=timezone.now()))
+    if not list(open_session.values_list('pk', flat=True)):
+        raise ValidationError("Test already finished")
+
+
 class TestSessionViewSet(viewsets.ViewSet):
     authentication_classes = (JWTAuthentication,)
     permission_classes = (IsAuthenticated, StudentOrAbove)
@@ -65,10 +98,12 @@ class TestSessionViewSet(viewsets.ViewSet):
     def retrieve(self, request, *args, **kwargs):
         pk = self.kwargs.get('pk')
         session = get_object_or_404(TestSession, pk=pk)
+        if expired(session):
+            session = finish_session(session.pk) or TestSession.objects.get(pk=session.pk)
         order = request.query_params.get('question', None)
         if not session.is_finished:
             if order:
-                question = get_object_or_404(TestQuestions, order=int(order) ,test_block=session.test_block)
+                question = sibling_at(siblings_of(TestQuestions, session.test_block_id), order)
                 serializer = TestWithSelectedAnswersSerializer(question, read_only=True)
                 return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -84,43 +119,38 @@ class TestSessionViewSet(viewsets.ViewSet):
                    parameters=[OpenApiParameter(name='uuid', required=True, location=OpenApiParameter.PATH, type=OpenApiTypes.STR),
                                OpenApiParameter(name='question', required=False, location=OpenApiParameter.QUERY, type=OpenApiTypes.INT)],
                    responses={200: OpenApiResponse(response={'oneOf': [TestWithSelectedAnswersSerializer, SessionTestSerializer]}),
+                              400: OpenApiResponse('Test already finished or its time is over'),
+                              403: OpenApiResponse('Not your test session'),
                               404: OpenApiResponse('Question/test not found')}
                    )
     def post(self, request, pk=None):
-        session = get_object_or_404(TestSession, pk=pk)
+        session = answerable_session(request, pk)
         question = request.query_params.get("question")
         if question:
-            question = get_object_or_404(TestQuestions, order=question, test_block=session.test_block)
+            question = sibling_at(siblings_of(TestQuestions, session.test_block_id), question)
             serializer = TestAnswersValidationSerializer(data=request.data, context={"question":question })
             serializer.is_valid(raise_exception=True)
             selected_answers = serializer.validated_data["selected_answers"]
-            TestUserAnswers.objects.filter(question=question, session=session).delete()
-            if selected_answers:
-                answers = TestAnswers.objects.filter(id__in=selected_answers, test=question)
-                new = TestUserAnswers.objects.create(question=question, session=session)
-                new.selected_answers.set(answers)
-
+            with transaction.atomic():
+                lock_answerable_session(session)
+                if write_behind_enabled():
+                    selected = question.test_answers.filter(id__in=selected_answers).values_list('id', flat=True)
+                    buffer_answers(session, {question.id: list(selected)})
+                else:
+                    TestUserAnswers.objects.filter(question=question, session=session).delete()
+                    if selected_answers:
+                        answers = TestAnswers.objects.filter(id__in=selected_answers, test=question)
+                        new = TestUserAnswers.objects.create(question=question, session=session)
+                        new.selected_answers.set(answers)
 
             output_serializer = TestWithSelectedAnswersSerializer(question, context={"session":session})
             return Response(output_serializer.data, status=status.HTTP_200_OK)
         else:
-            answers = request.data.get("answers",[])
-
-            for new_answer in answers:
-                question_id = new_answer.get("question")
-                answers_id = new_answer.get("selected_answer",[])
-
-                question = get_object_or_404(TestQuestions, id=question_id,test_block=session.test_block)
-
-                serializer = TestAnswersValidationSerializer(data={"selected_answers": answers_id}, context={"question":question})
-                serializer.is_valid(raise_exception=True)
-
-                TestUserAnswers.objects.filter(question=question, session=session).delete()
-
-                if answers_id:
-                    answers_ = TestAnswers.objects.filter(id__in=answers_id, test=question)
-                    new = TestUserAnswers.objects.create(question=question, session=session)
-                    new.selected_answers.set(answers_)
+            serializer = SessionAnswersBulkSerializer(data=request.data, context={"session": session})
+            serializer.is_valid(raise_exception=True)
+            with transaction.atomic():
+                lock_answerable_session(session)
+                serializer.save()
             output_serializer = SessionTestSerializer(session,read_only=True)
             return Response(output_serializer.data, status=status.HTTP_202_ACCEPTED)
 
@@ -137,19 +167,15 @@ class TestSubmitView(APIView):
 
     def post(self, request, pk=None):
         user = request.user
-        session = get_object_or_404(TestSession, pk=pk)
+        session = get_object_or_404(TestSession.objects.select_related('test_block'), pk=pk)
 
         if session.user != user:
             raise PermissionDenied("You don't have permission to submit this session")
         if session.is_finished:
             raise ValidationError(f"Test already finished at {session.finished_at}")
 
-        questions = session.test_block.questions.all()
-        score = check_test_results(questions, session)
-        with transaction.atomic():
-            session.is_finished = True
-            session.finished_at = timezone.now()
-            session.summary_score = score
-            session.save()
+        session = finish_session(session.pk)
+        if session is None:
+            raise ValidationError("Test already finished")
 
-        return Response({"score":score}, status=status.HTTP_200_OK)
+        return Response({"score":session.summary_score}, status=status.HTTP_200_OK)
@@ -3,6 +3,8 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from courses_app.models import TestQuestions, TestAnswers, TestBlock
+from courses_app.grading import record_question_change
+from courses_app.ordering import PositionField, PositionedListSerializer, ReorderSerializer, insert_rank
 from courses_app.utils import validate_answers
 from student_app.models import TestSession
 
@@ -15,20 +17,36 @@ class ShortTestSessionResultsSerializer(serializers.ModelSerializer):
         fields = ['uuid', 'summary_score', 'max_possible_score', 'finished_at']
 
     def get_max_possible_score(self, obj):
-        questions = obj.test_block.questions.all()
-        return sum(q.max_points for q in questions)
+        return obj.test_block.max_score
 
-class TestBlockGetUpdateSerializer(serializers.ModelSerializer):
-    order = serializers.SerializerMethodField()
-    user_results = ShortTestSessionResultsSerializer(source='test_sessions', read_only=True, many=True)
+
+class UserResultsMixin:
+    # only the requesting user's sessions, lecturers read everyone's through the results endpoint
+    def get_user_results(self, obj):
+        user = self.context.get('user')
+        if user is None or not user.is_authenticated:
+            return []
+        sessions = obj.test_sessions.filter(user=user).order_by('started_at')
+        return ShortTestSessionResultsSerializer(sessions, many=True).data
+
+
+class StudentTestResultsSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField()
+    username = serializers.CharField()
+    attempts = serializers.IntegerField()
+    best_score = serializers.FloatField()
+    mean_score = serializers.FloatField()
+    last_finished_at = serializers.DateTimeField()
+
+
+class TestBlockGetUpdateSerializer(UserResultsMixin, serializers.ModelSerializer):
+    order = PositionField(source='section')
+    user_results = serializers.SerializerMethodField()
 
     class Meta:
         model = TestBlock
         fields = ['order','id', 'test_title' ,'test_description', 'time_for_test','possible_retries','user_results' ]
 
-    def get_order(self,obj):
-        return obj.section.order
-
 
     def update(self, instance, validated_data):
         block = self.context.get('block')
@@ -61,25 +79,24 @@ class TestSessionAnswerSerializer(serializers.ModelSerializer):
         fields = ['id', 'order', 'answer_text',]
 
 class RawTestSerializer(serializers.ModelSerializer):
+    order = PositionField()
     test_answers = TestAnswerSerializer(many=True, read_only=True)
     class Meta:
         model = TestQuestions
         fields = ['id', 'order','test_question','test_answers']
+        list_serializer_class = PositionedListSerializer
 
 
-class AdminTestBlockSerializer(serializers.ModelSerializer):
-    order = serializers.SerializerMethodField()
+class AdminTestBlockSerializer(UserResultsMixin, serializers.ModelSerializer):
+    order = PositionField(source='section')
     tests = RawTestSerializer(source='questions' ,many=True)
     time_for_test = serializers.SerializerMethodField()
-    user_results = ShortTestSessionResultsSerializer(source='test_sessions', read_only=True, many=True)
+    user_results = serializers.SerializerMethodField()
 
     class Meta:
         model = TestBlock
         fields = ['order','id', 'test_title', 'test_description','time_for_test','possible_retries', 'user_results' ,'tests']
 
-    def get_order(self,obj):
-        return obj.section.order
-
     def get_time_for_test(self,obj):
         return obj.time_for_test
 
@@ -96,7 +113,8 @@ class TestAnswersCreateSerializer(serializers.ModelSerializer):
 
 
 class TestCreateUpdateSerializer(serializers.ModelSerializer):
-    order = serializers.IntegerField(required=False)
+    # position of the question, appended on create when left out
+    order = serializers.IntegerField(required=False, min_value=1)
     test_answers = TestAnswersCreateSerializer(many=True)
     class Meta:
         model = TestQuestions
@@ -119,24 +137,31 @@ class TestCreateUpdateSerializer(serializers.ModelSerializer):
         answers_data = validated_data.pop('test_answers')
         test = self.context.get('test')
 
-        if not validated_data.get('order') or validated_data['order'] is None:
-            validated_data['order'] = TestQuestions.objects.filter(test_block=test).count()+1
-
+        position = validated_data.pop('order', None)
         with transaction.atomic():
+            validated_data['order'] = insert_rank(TestQuestions, test.id, position)
             question = TestQuestions.objects.create(test_block=test,**validated_data)
             for answer_data in answers_data:
                 TestAnswers.objects.create(test=question,**answer_data)
+            record_question_change(test.id, questions=1, points=question.max_points)
         return question
 
 
     @transaction.atomic
     def update(self, instance, validated_data):
         answers_data = validated_data.pop('test_answers', [])
-
+        position = validated_data.pop('order', None)
+        # locked, so concurrent edits of the question shift max_score by what they actually changed
+        old_max_points = TestQuestions.objects.select_for_update().values_list('max_points', flat=True) \
+            .get(pk=instance.pk)
+        if position is not None:
+            self.move_to(instance, position)
 
         for field, value in validated_data.items():
             setattr(instance, field, value)
-        instance.save()
+        if validated_data:
+            # never the loaded order, a concurrent reorder or rebalance may have moved it since
+            instance.save(update_fields=list(validated_data))
 
         old_answers = {answer.order: answer for answer in instance.test_answers.all()}
         orders = set()
@@ -157,6 +182,16 @@ class TestCreateUpdateSerializer(serializers.ModelSerializer):
             for order, answer in old_answers.items():
                 if order not in orders:
                     answer.delete()
+        record_question_change(instance.test_block_id, points=instance.max_points - old_max_points)
         return instance
 
+    def move_to(self, question, position):
+        siblings = question.test_block.questions.all()
+        others = list(siblings.exclude(pk=question.pk).order_by('order').values_list('id', flat=True))
+        before = others[position - 1] if position <= len(others) else None
+        reorder = ReorderSerializer(data={'move': question.pk, 'before': before}, context={'siblings': siblings})
+        reorder.is_valid(raise_exception=True)
+        reorder.save()
+        question.refresh_from_db(fields=['order'])
+
 
@@ -1,3 +1,151 @@
-from django.test import TestCase
+import io
+from datetime import timedelta
 
-# Create your tests here.
+import pytest
+from django.apps import apps
+from django.core.management import call_command
+from django.utils import timezone
+
+from courses_app.grading import grade_session
+from courses_app.signals import backfill_test_totals
+from student_app.models import TestSession, TestUserAnswers
+from teacher_app.serializers import TestBlockGetUpdateSerializer, TestCreateUpdateSerializer
+
+from conftest import *
+
+
+def finished_session(exam, user, picks, minutes_ago=10):
+    # picks: {question order: [answer orders]}
+    session = TestSession.objects.create(test_block=exam, user=user)
+    for question in exam.questions.all():
+        if question.order in picks:
+            user_answer = TestUserAnswers.objects.create(session=session, question=question)
+            user_answer.selected_answers.set(question.test_answers.filter(order__in=picks[question.order]))
+    session.summary_score = grade_session(session)
+    session.is_finished = True
+    session.finished_at = timezone.now() - timedelta(minutes=minutes_ago)
+    session.save()
+    return session
+
+
+@pytest.mark.django_db
+def test_item_analysis_incremental(teacher_with_auth, exam, user_student):
+    url = f'/courses/{exam.section.section.course_id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/analysis/'
+    finished_session(exam, user_student, {1: [1], 2: [1, 2], 3: [2]}, minutes_ago=40)
+    finished_session(exam, user_student, {1: [1], 2: [1], 3: [1]}, minutes_ago=30)
+    finished_session(exam, user_student, {1: [2], 3: [1]}, minutes_ago=20)
+
+    response = teacher_with_auth.get(url)
+    assert response.status_code == 200
+    assert response.data['sessions'] == 3
+    single, multiple, double = response.data['questions']
+    assert single['p_value'] == pytest.approx(2 / 3, abs=1e-3)
+    assert double['p_value'] == pytest.approx(1 / 3, abs=1e-3)
+    assert double['point_biserial'] > 0
+    assert [a['selection_rate'] for a in single['answers']] == pytest.approx([2 / 3, 1 / 3], abs=1e-3)
+    assert [a['is_correct'] for a in multiple['answers']] == [True, True, False]
+
+    finished_session(exam, user_student, {1: [1], 2: [1, 2], 3: [2]}, minutes_ago=5)
+    response = teacher_with_auth.get(url)
+    assert response.data['sessions'] == 4
+    assert response.data['questions'][1]['p_value'] == pytest.approx(0.5, abs=1e-3)
+
+    # committed late with a finish time behind the watermark
+    finished_session(exam, user_student, {1: [1]}, minutes_ago=50)
+    response = teacher_with_auth.get(url)
+    assert response.data['sessions'] == 5
+
+
+@pytest.mark.django_db
+def test_item_analysis_forbidden_for_students(student_with_auth, exam):
+    url = f'/courses/{exam.section.section.course_id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/analysis/'
+    assert student_with_auth.get(url).status_code == 403
+
+
+@pytest.mark.django_db
+def test_test_totals_follow_question_changes(teacher_with_auth, exam, user_student, django_assert_max_num_queries):
+    assert (exam.question_count, exam.max_score) == (3, 4)
+    url = f'/courses/{exam.section.section.course_id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/'
+    course = Course.objects.filter(pk=exam.section.section.course_id)
+    version = course.values_list('content_version', flat=True).get()
+    response = teacher_with_auth.post(url, {'test_question': 'new one', 'test_answers_type': 'single', 'max_points': 5,
+                                            'test_answers': [{'order': 1, 'answer_text': 'yes', 'is_correct': True},
+                                                             {'order': 2, 'answer_text': 'no', 'is_correct': False}]},
+                                      format='json')
+    assert response.status_code == 201
+    # one content version bump for the question and its answers
+    assert course.values_list('content_version', flat=True).get() == version + 1
+    question_id = response.data['id']
+    response = teacher_with_auth.patch(f'{url}{question_id}/', {'max_points': 2}, format='json')
+    assert response.status_code == 200
+    exam.refresh_from_db()
+    assert (exam.question_count, exam.max_score) == (4, 6)
+
+    response = teacher_with_auth.delete(f'{url}{exam.questions.get(order=3).id}/')
+    assert response.status_code == 202
+    exam.refresh_from_db()
+    assert (exam.question_count, exam.max_score) == (3, 4)
+
+    TestBlock.objects.filter(pk=exam.pk).update(max_score=0, question_count=0)
+    call_command('repair_test_totals', stdout=io.StringIO())
+    exam.refresh_from_db()
+    assert (exam.question_count, exam.max_score) == (3, 4)
+
+    # tests that existed before the columns are filled in after migrate
+    TestBlock.objects.filter(pk=exam.pk).update(max_score=0, question_count=0)
+    backfill_test_totals(sender=apps.get_app_config('courses_app'), using='default')
+    exam.refresh_from_db()
+    assert (exam.question_count, exam.max_score) == (3, 4)
+
+    for minutes in range(5):
+        finished_session(exam, user_student, {}, minutes_ago=minutes + 1)
+    # test block, its block position and the sessions, not one query per session
+    with django_assert_max_num_queries(3):
+        data = TestBlockGetUpdateSerializer(TestBlock.objects.select_related('section').get(pk=exam.pk),
+                                            context={'user': user_student}).data
+    assert {result['max_possible_score'] for result in data['user_results']} == {4}
+
+
+@pytest.mark.django_db
+def test_results_scoped_and_aggregated(teacher_with_auth, exam, user_student):
+    other = SiteUser.objects.create_student(username="other_student", password="1234")
+    CourseRoles.objects.create(course=exam.section.section.course, user=other, course_role='student')
+    finished_session(exam, user_student, {1: [1]}, minutes_ago=3)
+    finished_session(exam, user_student, {1: [1], 3: [2]}, minutes_ago=2)
+    finished_session(exam, other, {3: [2]}, minutes_ago=1)
+
+    data = TestBlockGetUpdateSerializer(exam, context={'user': other}).data
+    assert [result['summary_score'] for result in data['user_results']] == [2]
+    assert TestBlockGetUpdateSerializer(exam).data['user_results'] == []
+
+    url = f'/courses/{exam.section.section.course_id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/results/'
+    response = teacher_with_auth.get(url, {'page_size': 1})
+    assert response.status_code == 200
+    assert response.data['summary']['sessions'] == 3
+    assert response.data['summary']['students'] == 2
+    assert response.data['summary']['max_score'] == 4
+    first = response.data['results'][0]
+    assert (first['user_id'], first['attempts'], first['best_score'], first['mean_score']) == (user_student.id, 2, 3, 2)
+    assert isinstance(first['best_score'], float)
+
+    response = teacher_with_auth.get(url, {'page_size': 1, 'cursor': response.data['next']})
+    assert [row['username'] for row in response.data['results']] == ['other_student']
+    assert response.data['next'] is None
+
+
+@pytest.mark.django_db
+def test_results_forbidden_for_students(student_with_auth, exam):
+    url = f'/courses/{exam.section.section.course_id}/sections/{exam.section.section_id}/blocks/{exam.section_id}/tests/results/'
+    assert student_with_auth.get(url).status_code == 403
+
+
+@pytest.mark.django_db
+def test_question_update_keeps_concurrent_rank(exam):
+    question = exam.questions.get(order=1)
+    # a reorder committed after this instance was loaded
+    TestQuestions.objects.filter(pk=question.pk).update(order=5000)
+    serializer = TestCreateUpdateSerializer(question, data={'max_points': 3}, partial=True)
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+    question.refresh_from_db()
+    assert (question.order, question.max_points) == (5000, 3)
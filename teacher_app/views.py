@@ -1,3 +1,5 @@
+from django.db import transaction
+from django.http import Http404
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 from rest_framework import status, viewsets
@@ -10,11 +12,18 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
 from courses_app.models import CourseSections, Course, TestQuestions, TestBlock, SectionContent
+from courses_app.ordering import ReorderSerializer
 from courses_app.serializers import SectionContentCreateUpdateSerializer, SectionContentSerializer, \
     AdminSectionContentMultiSerializer
-from courses_app.utils import check_object_permissions
+from courses_app.analysis import item_analysis
+from courses_app.grading import record_question_change, student_results, results_summary
+from courses_app.leaderboard import leaderboard, leaderboard_size
+from courses_app.pagination import KeysetPagination
+from courses_app.utils import check_object_permissions, resolve_course_path
 from main.permissions import CoLecturerOrAbove, StudentOrAbove
-from teacher_app.serializers import TestCreateUpdateSerializer, RawTestSerializer
+from student_app.models import TestScore
+from teacher_app.serializers import TestCreateUpdateSerializer, RawTestSerializer, StudentTestResultsSerializer, \
+    TestAnswerSerializer
 
 
 # Create your views here.
@@ -24,13 +33,6 @@ class TestViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, StudentOrAbove)
     authentication_classes = (JWTAuthentication,)
 
-    def get_block_and_test(self, course_pk, section_pk, block_pk):
-        course = get_object_or_404(Course,pk=course_pk)
-        section = get_object_or_404(CourseSections,pk=section_pk,course=course)
-        block = get_object_or_404(SectionContent, pk=block_pk, section=section)
-        test = get_object_or_404(TestBlock, section=block)
-        return block, test
-
     @extend_schema(summary="get test question",
                    parameters=[
         OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
@@ -48,8 +50,7 @@ class TestViewSet(viewsets.ModelViewSet):
         block_pk = self.kwargs.get('block_pk')
         pk = self.kwargs.get('pk')
 
-        block, test = self.get_block_and_test(course_pk,section_pk,block_pk)
-        test_questions = get_object_or_404(TestQuestions, pk=pk, test_block=test)
+        test_questions = resolve_course_path(request, course_pk, section_pk, block_pk, question_pk=pk).question
         serializer = RawTestSerializer(test_questions)
         return Response(serializer.data,status=status.HTTP_200_OK)
 
@@ -69,15 +70,12 @@ class TestViewSet(viewsets.ModelViewSet):
         section_pk = self.kwargs.get('section_pk')
         block_pk = self.kwargs.get('block_pk')
 
-        course = get_object_or_404(Course, pk=course_pk)
-        section = get_object_or_404(CourseSections, pk=section_pk, course=course)
+        course, section, block, test, _ = resolve_course_path(request, course_pk, section_pk, block_pk, test=True)
 
         if not CoLecturerOrAbove().has_object_permission(request, self,course):
             raise PermissionDenied("You're not allowed to do this ")
 
         else:
-            block = get_object_or_404(SectionContent, pk=block_pk, section=section)
-            test = get_object_or_404(TestBlock, section=block)
             serializer = TestCreateUpdateSerializer(data=request.data,context={'test': test})
             serializer.is_valid(raise_exception=True)
             serializer.save()
@@ -101,12 +99,10 @@ class TestViewSet(viewsets.ModelViewSet):
         section_pk = self.kwargs.get('section_pk')
         block_pk = self.kwargs.get('block_pk')
         pk = self.kwargs.get('pk')
-        course = get_object_or_404(Course, pk=course_pk)
-        block, test = self.get_block_and_test(course_pk, section_pk, block_pk)
-        check_object_permissions(self, request, course)
-
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, question_pk=pk)
+        check_object_permissions(self, request, path.course)
 
-        questions = get_object_or_404(TestQuestions, pk=pk, test_block=test)
+        questions = path.question
         serializer = TestCreateUpdateSerializer(instance=questions, data=request.data, partial=True,)
         serializer.is_valid(raise_exception=True)
         serializer.save()
@@ -131,10 +127,136 @@ class TestViewSet(viewsets.ModelViewSet):
         block_pk = self.kwargs.get('block_pk')
         pk = self.kwargs.get('pk')
 
-        block, test = self.get_block_and_test(course_pk, section_pk, block_pk)
-        question = get_object_or_404(TestQuestions, pk=pk, test_block=test)
-        question.delete()
-        output_serializer = AdminSectionContentMultiSerializer(block)
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, question_pk=pk)
+        block = path.block
+        with transaction.atomic():
+            max_points = TestQuestions.objects.select_for_update().filter(pk=path.question.pk) \
+                .values_list('max_points', flat=True).first()
+            if max_points is None:
+                raise Http404('Question not found')
+            path.question.delete()
+            record_question_change(path.test.id, questions=-1, points=-max_points)
+        output_serializer = AdminSectionContentMultiSerializer(block, context={'user': request.user})
         return Response(output_serializer.data, status=status.HTTP_202_ACCEPTED)
 
+    @extend_schema(summary="test item analysis",
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT)],
+                   responses={200: OpenApiResponse(description="p-value, point-biserial and answer selection rates "
+                                                               "per question over finished sessions"),
+                              404: OpenApiResponse(description="Block/Section/Test not found"),
+                              403: OpenApiResponse(description="Permission Denied")}
+                   )
+    @action(detail=False, methods=['get'], url_path='analysis')
+    def analysis(self, request, *args, **kwargs):
+        course_pk = self.kwargs.get('course_pk')
+        section_pk = self.kwargs.get('section_pk')
+        block_pk = self.kwargs.get('block_pk')
+
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, test=True)
+        if not CoLecturerOrAbove().has_object_permission(request, self, path.course):
+            raise PermissionDenied("You're not allowed to do this ")
+        return Response(item_analysis(path.test), status=status.HTTP_200_OK)
+
+    @extend_schema(summary="test results per student",
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='cursor', location=OpenApiParameter.QUERY, required=False, type=OpenApiTypes.STR),
+                       OpenApiParameter(name='page_size', location=OpenApiParameter.QUERY, required=False, type=OpenApiTypes.INT)],
+                   responses={200: OpenApiResponse(response=StudentTestResultsSerializer(many=True),
+                                                   description="summary of finished sessions and a page of "
+                                                               "attempts / best / mean score per student"),
+                              404: OpenApiResponse(description="Block/Section/Test not found"),
+                              403: OpenApiResponse(description="Permission Denied")}
+                   )
+    @action(detail=False, methods=['get'], url_path='results')
+    def results(self, request, *args, **kwargs):
+        course_pk = self.kwargs.get('course_pk')
+        section_pk = self.kwargs.get('section_pk')
+        block_pk = self.kwargs.get('block_pk')
+
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, test=True)
+        if not CoLecturerOrAbove().has_object_permission(request, self, path.course):
+            raise PermissionDenied("You're not allowed to do this ")
+
+        paginator = KeysetPagination(keyset_fields=('user_id',))
+        page = paginator.paginate_queryset(student_results(path.test), request, view=self)
+        response = paginator.get_paginated_response(StudentTestResultsSerializer(page, many=True).data)
+        response.data['summary'] = results_summary(path.test)
+        return response
+
+    @extend_schema(summary="test leaderboard",
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='limit', location=OpenApiParameter.QUERY, required=False, type=OpenApiTypes.INT)],
+                   responses={200: OpenApiResponse(description="Top students by best score, with the caller's "
+                                                               "rank and percentile"),
+                              404: OpenApiResponse(description="Block/Section/Test not found"),
+                              403: OpenApiResponse(description="Permission Denied")}
+                   )
+    @action(detail=False, methods=['get'], url_path='leaderboard')
+    def leaderboard(self, request, *args, **kwargs):
+        course_pk = self.kwargs.get('course_pk')
+        section_pk = self.kwargs.get('section_pk')
+        block_pk = self.kwargs.get('block_pk')
+
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, test=True)
+        check_object_permissions(self, request, path.course)
+        data = leaderboard(TestScore.objects.filter(test_block=path.test), 'best_score', request.user,
+                           limit=leaderboard_size(request))
+        return Response(data, status=status.HTTP_200_OK)
+
+    @extend_schema(summary="reorder test questions",
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT)],
+                   request=ReorderSerializer,
+                   responses={200: RawTestSerializer(many=True),
+                              404: OpenApiResponse(description="Block/Section/Test not found"),
+                              403: OpenApiResponse(description="Permission Denied")}
+                   )
+    @action(detail=False, methods=['post'], url_path='reorder')
+    def reorder(self, request, *args, **kwargs):
+        course_pk = self.kwargs.get('course_pk')
+        section_pk = self.kwargs.get('section_pk')
+        block_pk = self.kwargs.get('block_pk')
+
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, test=True)
+        if not CoLecturerOrAbove().has_object_permission(request, self, path.course):
+            raise PermissionDenied("You're not allowed to do this ")
+        serializer = ReorderSerializer(data=request.data, context={'siblings': path.test.questions.all()})
+        serializer.is_valid(raise_exception=True)
+        questions = serializer.save().prefetch_related('test_answers')
+        return Response(RawTestSerializer(questions, many=True).data, status=status.HTTP_200_OK)
+
+    @extend_schema(summary="reorder answers of a test question",
+                   parameters=[
+                       OpenApiParameter(name='course_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='section_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='block_pk', location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT),
+                       OpenApiParameter(name='pk', description="test_pk", location=OpenApiParameter.PATH, required=True, type=OpenApiTypes.INT)],
+                   request=ReorderSerializer,
+                   responses={200: TestAnswerSerializer(many=True),
+                              404: OpenApiResponse(description="Block/Section/Test question not found"),
+                              403: OpenApiResponse(description="Permission Denied")}
+                   )
+    @action(detail=True, methods=['post'], url_path='answers/reorder')
+    def reorder_answers(self, request, *args, **kwargs):
+        course_pk = self.kwargs.get('course_pk')
+        section_pk = self.kwargs.get('section_pk')
+        block_pk = self.kwargs.get('block_pk')
+        pk = self.kwargs.get('pk')
 
+        path = resolve_course_path(request, course_pk, section_pk, block_pk, question_pk=pk)
+        if not CoLecturerOrAbove().has_object_permission(request, self, path.course):
+            raise PermissionDenied("You're not allowed to do this ")
+        serializer = ReorderSerializer(data=request.data, context={'siblings': path.question.test_answers.all()})
+        serializer.is_valid(raise_exception=True)
+        return Response(TestAnswerSerializer(serializer.save(), many=True).data, status=status.HTTP_200_OK)